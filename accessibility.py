@@ -0,0 +1,200 @@
+from typing import Any, Dict, List, Optional, Tuple
+from playwright.sync_api import Page
+from webpage import ID_TAGS
+
+# Roles that only group other nodes. They are skipped and their children are
+# rendered in their place unless they carry a name.
+STRUCTURAL_ROLES = {
+    "generic",
+    "none",
+    "presentation",
+    "group",
+    "LineBreak",
+    "InlineTextBox",
+    "RootWebArea",
+    "WebArea",
+}
+
+# Boolean/tristate AX properties that are worth showing to the LLM
+STATE_PROPERTIES = [
+    "checked",
+    "disabled",
+    "expanded",
+    "focused",
+    "invalid",
+    "pressed",
+    "readonly",
+    "required",
+    "selected",
+]
+
+
+def get_dom_node_info(dom_root: Dict[str, Any]) -> Dict[int, Tuple[str, Optional[str]]]:
+    """
+    Map each element's backendNodeId to its xpath and its id.
+
+    Elements get ids by the same rules as `simplify_html`: a site provided id,
+    an interactive element's `name`, and otherwise a running counter over
+    interactive elements in document order. Elements that share an id, such as
+    radio inputs with the same name, get their own. `render_ax_tree` replaces
+    these with compact tokens before they reach the prompt.
+    """
+    node_info = {}
+    curr_id = 1
+    seen_ids = set()
+    stack = [(dom_root, "")]
+
+    while stack:
+        current, xpath = stack.pop()
+        children = current.get("children", [])
+
+        if current.get("nodeType") == 1:
+            attributes = current.get("attributes", [])
+            attrs = dict(zip(attributes[::2], attributes[1::2]))
+            tag_name = current["localName"]
+
+            element_id = attrs.get("id") or None
+            if tag_name in ID_TAGS:
+                if element_id is None:
+                    element_id = attrs.get("name") or str(curr_id)
+                curr_id += 1
+
+            if element_id is not None:
+                unique_id = element_id
+                suffix = 2
+                while unique_id in seen_ids:
+                    unique_id = f"{element_id}-{suffix}"
+                    suffix += 1
+                element_id = unique_id
+                seen_ids.add(element_id)
+
+            node_info[current["backendNodeId"]] = (xpath, element_id)
+
+        # Generate the xpath segment for each child element
+        element_children = [child for child in children if child.get("nodeType") == 1]
+        stack_children = []
+        for child in element_children:
+            siblings = [
+                sib
+                for sib in element_children
+                if sib["localName"] == child["localName"]
+            ]
+            count = siblings.index(child) + 1
+            xpath_segment = (
+                f"{child['localName']}[{count}]"
+                if len(siblings) > 1
+                else child["localName"]
+            )
+            stack_children.append((child, f"{xpath}/{xpath_segment}"))
+
+        # Reverse the order of children to maintain the correct order when popping from the stack
+        stack.extend(reversed(stack_children))
+
+    return node_info
+
+
+def _ax_value(ax_node: Dict[str, Any], key: str):
+    return (ax_node.get(key) or {}).get("value")
+
+
+def format_ax_node(ax_node: Dict[str, Any], element_id: Optional[str]) -> str:
+    role = _ax_value(ax_node, "role")
+    name = _ax_value(ax_node, "name")
+    value = _ax_value(ax_node, "value")
+
+    line = [f"[{element_id}]"] if element_id is not None else []
+    line.append(role)
+    if name:
+        line.append(f'"{name.strip()}"')
+    if value not in (None, ""):
+        line.append(f'value="{value}"')
+
+    states = []
+    for prop in ax_node.get("properties", []):
+        prop_value = (prop.get("value") or {}).get("value")
+        if prop["name"] in STATE_PROPERTIES and prop_value not in (
+            None,
+            False,
+            "false",
+        ):
+            states.append(
+                prop["name"]
+                if prop_value in (True, "true")
+                else f"{prop['name']}={prop_value}"
+            )
+    if states:
+        line.append(f"({', '.join(states)})")
+
+    return " ".join(line)
+
+
+def render_ax_tree(
+    ax_nodes: List[Dict[str, Any]],
+    node_info: Dict[int, Tuple[str, Optional[str]]],
+) -> Tuple[str, Dict[str, str]]:
+    ax_nodes_by_id = {ax_node["nodeId"]: ax_node for ax_node in ax_nodes}
+    root = next(
+        (ax_node for ax_node in ax_nodes if "parentId" not in ax_node), ax_nodes[0]
+    )
+
+    lines = []
+    id_to_xpath = {}
+    stack = [(root, 0, None)]  # Tuple of (ax node, depth, parent name)
+
+    while stack:
+        ax_node, depth, parent_name = stack.pop()
+        role = _ax_value(ax_node, "role")
+        name = (_ax_value(ax_node, "name") or "").strip()
+
+        xpath, element_id = node_info.get(ax_node.get("backendDOMNodeId"), (None, None))
+
+        rendered = False
+        if ax_node.get("ignored"):
+            pass
+        elif role == "StaticText":
+            # Text already used as the accessible name of its parent is redundant
+            if name and name != parent_name:
+                lines.append("  " * depth + name)
+                rendered = True
+        elif role not in STRUCTURAL_ROLES or name:
+            if element_id is not None and xpath is not None:
+                # Site provided ids can be long, so rendered elements are
+                # numbered in order like `compact_element_ids` does for html
+                element_id = str(len(id_to_xpath) + 1)
+                id_to_xpath[element_id] = xpath
+            else:
+                element_id = None
+            lines.append("  " * depth + format_ax_node(ax_node, element_id))
+            rendered = True
+
+        children = [
+            (
+                ax_nodes_by_id[child_id],
+                depth + 1 if rendered else depth,
+                name if rendered else parent_name,
+            )
+            for child_id in ax_node.get("childIds", [])
+            if child_id in ax_nodes_by_id
+        ]
+        # Reverse the order of children to maintain the correct order when popping from the stack
+        stack.extend(reversed(children))
+
+    return "\n".join(lines), id_to_xpath
+
+
+def get_accessibility_tree(page: Page) -> Tuple[str, Dict[str, str]]:
+    """
+    Build a compact text representation of the page from Chromium's accessibility
+    tree, along with the id to xpath mapping that actions resolve against.
+    """
+    cdp_session = page.context.new_cdp_session(page)
+    try:
+        dom_root = cdp_session.send("DOM.getDocument", {"depth": -1})["root"]
+        ax_nodes = cdp_session.send("Accessibility.getFullAXTree")["nodes"]
+    finally:
+        cdp_session.detach()
+
+    if not ax_nodes:
+        return "", {}
+
+    return render_ax_tree(ax_nodes, get_dom_node_info(dom_root))
@@ -1,19 +1,36 @@
 from __future__ import annotations
 import re
-from typing import List, Callable, Optional, Dict, Any, Tuple
+from typing import List, Callable, Optional, Dict, Any, Set, Tuple
 from bs4 import BeautifulSoup
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pydantic import BaseModel, Field
 import textwrap
-from playwright.sync_api import Page, sync_playwright
+from playwright.sync_api import BrowserContext, Page, sync_playwright
 import ast
-from webpage import html_diff, simplify_html, sanitize_html_for_diffing
-from llm import GeminiUsage, call_gemini
-import minify_html
-from termcolor import colored, cprint
+from webpage import (
+    html_diff,
+    simplify_html,
+    sanitize_html_for_diffing,
+    serialize_simplified_html,
+    summarize_html,
+)
+from accessibility import get_accessibility_tree
+from html_processing import HTMLProcessingService
+from dom_tracking import DOMTracker
+from macros import MacroReplay, MacroStep, MacroStore, page_domain
+from llm import GeminiUsage, StructuredLLMOutput, call_gemini, call_gemini_with_tools
+from agent_logging import configure_logging, logger, set_log_context, shutdown_logging
 import inspect
 import time
+import weakref
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum
+from urllib.parse import urljoin, urlparse
+
+# Seconds to let the page settle after a click or navigation
+ACTION_SETTLE_SECONDS = 5
 
 
 @dataclass
@@ -74,10 +91,143 @@ def choose_dropdown_values(id: str, values: List[str], page, id_to_xpath):
     return ""
 
 
+class SelectOptionsByIdArgs(BaseModel):
+    id: str = Field(description="The ID of the <select> tag")
+    values: List[str] = Field(description="The option value(s) to select")
+
+
 class SelectOptionsByIdAction(Action):
     description = "Select value(s) for a <select> tag identified by its ID. The `values` list must contain at least one string option to select. Important: This function can ONLY be called with an ID that belongs directly to a <select> tag."
     fn = choose_dropdown_values
-    args = BaseModel
+    args = SelectOptionsByIdArgs
+
+
+# Upper bound on the number of tabs opened by a single explore_links call
+MAX_EXPLORED_TABS = 5
+
+
+def active_page(page: Page) -> Page:
+    # The agent continues on the most recently opened tab once its page is closed
+    return page if not page.is_closed() else page.context.pages[-1]
+
+
+# The tabs opened by the last explore_links call in each browser context, in the
+# order they were numbered for the LLM. Popups opened by the site are not in it.
+_explored_tabs: weakref.WeakKeyDictionary[BrowserContext, List[Page]] = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def explored_tabs(page: Page) -> List[Page]:
+    return _explored_tabs.get(page.context, [])
+
+
+def explore_links(
+    targets: List[str],
+    page,
+    id_to_xpath,
+    processing_service: Optional[HTMLProcessingService] = None,
+):
+    for tab in explored_tabs(page):
+        if not tab.is_closed():
+            tab.close()
+    _explored_tabs.pop(page.context, None)
+
+    urls = []
+    for target in targets:
+        if target in id_to_xpath:
+            href = page.locator(f"xpath={id_to_xpath[target]}").get_attribute("href")
+            if href and not href.startswith(("#", "javascript:")):
+                urls.append(urljoin(page.url, href))
+        elif "." in target:
+            urls.append(target if "://" in target else f"https://{target}")
+
+    if not urls:
+        raise Exception("None of the targets are links or URLs that can be opened")
+
+    # Start every navigation before waiting on any, so the pages load in parallel
+    tabs = []
+    try:
+        for url in urls[:MAX_EXPLORED_TABS]:
+            tab = page.context.new_page()
+            tabs.append(tab)
+            tab.goto(url, wait_until="commit")
+    except Exception:
+        for tab in tabs:
+            tab.close()
+        raise
+    _explored_tabs[page.context] = tabs
+    for tab in tabs:
+        try:
+            tab.wait_for_load_state("load")
+        except Exception:
+            pass
+    page.bring_to_front()
+
+    htmls = [tab.content() for tab in tabs]
+    if processing_service:
+        summaries = processing_service.summarize_many(htmls)
+    else:
+        summaries = [summarize_html(html) for html in htmls]
+
+    return "\n\n".join(
+        f"Tab {i + 1}: {tab.url}\n{summary}"
+        for i, (tab, summary) in enumerate(zip(tabs, summaries))
+    )
+
+
+class ExploreLinksArgs(BaseModel):
+    targets: List[str] = Field(
+        description="The ids of <a> tags, or URLs, to open in new tabs"
+    )
+
+
+class ExploreLinksAction(Action):
+    description = f"Open up to {MAX_EXPLORED_TABS} candidate links (ids of <a> tags) or URLs in parallel tabs and get a short summary of each page, without leaving the current page. Use this when you are unsure which link leads to the goal, then call choose_explored_tab."
+    fn = explore_links
+    args = ExploreLinksArgs
+
+
+def choose_explored_tab(tab: int, page, id_to_xpath=None):
+    tabs = explored_tabs(page)
+    if not 1 <= tab <= len(tabs):
+        raise Exception(f"There are only {len(tabs)} explored tabs")
+
+    chosen_tab = tabs[tab - 1]
+    if chosen_tab.is_closed():
+        raise Exception(f"Tab {tab} was closed")
+    _explored_tabs.pop(page.context, None)
+    for other_page in page.context.pages:
+        if other_page != chosen_tab:
+            other_page.close()
+    chosen_tab.bring_to_front()
+    return ""
+
+
+class ChooseExploredTabArgs(BaseModel):
+    tab: int = Field(description="The number of the explored tab to continue on")
+
+
+class ChooseExploredTabAction(Action):
+    description = "Continue the task on one of the tabs opened by explore_links, identified by its tab number. All other tabs, including the current page, are closed."
+    fn = choose_explored_tab
+    args = ChooseExploredTabArgs
+
+
+def finish_task(answer: str, page, id_to_xpath=None):
+    return ""
+
+
+class FinishTaskArgs(BaseModel):
+    answer: str = Field(
+        description="What was done to complete the task, or the information the user asked for"
+    )
+
+
+class FinishTaskAction(Action):
+    description = "Call this only once the task is fully complete, to end the session. Important: Do not call it while any step of the task remains."
+    fn = finish_task
+    args = FinishTaskArgs
 
 
 class TypeTextArgs(BaseModel):
@@ -94,10 +244,21 @@ class TypeTextAction(Action):
 class ActionToExecute:
     action_name: str
     args: str
+    # Already parsed arguments, set when the action came from a function call
+    kwargs: Optional[Dict[str, Any]] = None
 
     def __str__(self):
         return f"{self.action_name}({self.args})"
 
+    @classmethod
+    def from_function_call(cls, name: str, kwargs: Dict[str, Any]) -> ActionToExecute:
+        args_str = ", ".join(f"{key}={value!r}" for key, value in kwargs.items())
+        return cls(action_name=name, args=args_str, kwargs=kwargs)
+
+
+class LLMOutputParseError(Exception):
+    pass
+
 
 @dataclass
 class TurnException:
@@ -118,6 +279,8 @@ class Turn:
     status: TurnStatus
     exception: Optional[TurnException] = None
     html_diff: Optional[str] = None
+    # What the action returned for the LLM to read, e.g. the explored tab summaries
+    action_result: Optional[str] = None
 
     def execute_actions(self):
         for action_to_execute in self.actions_to_execute:
@@ -134,48 +297,50 @@ class Turn:
                 args = []
                 kwargs = {}
 
-                # Split the string by commas to handle args and kwargs separately
-                # This time, we need to account for potential commas within the kwarg values
-                parts = []
-                buffer = ""
-                inside_quotes = False
-                for char in action_to_execute.args:
-                    if char in ("'", '"'):
-                        inside_quotes = not inside_quotes
-                    elif char == "," and not inside_quotes:
-                        parts.append(buffer.strip())
-                        buffer = ""
-                        continue
-                    buffer += char
-                parts.append(buffer.strip())  # Add the last buffered part
-
-                # Process each part to separate args and kwargs
-                for part in parts:
-                    if "=" in part and not inside_quotes:
-                        # This is a kwarg, find the first '=' that separates the key and value
-                        split_index = part.index("=")
-                        key = part[:split_index].strip()
-                        value = part[split_index + 1 :].strip()
-                        # Use ast.literal_eval to safely evaluate the value
-                        kwargs[key] = ast.literal_eval(value)
-                    else:
-                        # This is an arg, use ast.literal_eval for safe evaluation
-                        args.append(ast.literal_eval(part))
-
-                cprint(
-                    f"Executing {action.fn.__name__}({action_to_execute.args})",
-                    "magenta",
-                )
+                if action_to_execute.kwargs is not None:
+                    try:
+                        # Function calls are validated against the action's args model
+                        kwargs = action.args(**action_to_execute.kwargs).model_dump()
+                    except Exception as e:
+                        self.status = TurnStatus.FAILED
+                        self.exception = TurnException(
+                            python_code=str(action_to_execute),
+                            exception=e,
+                        )
+                        raise e
+                else:
+                    # Parse the arguments the same way python would, so that lists
+                    # and strings containing commas or quotes are handled
+                    try:
+                        call = ast.parse(
+                            f"f({action_to_execute.args})", mode="eval"
+                        ).body
+                        args = [ast.literal_eval(arg) for arg in call.args]
+                        kwargs = {
+                            keyword.arg: ast.literal_eval(keyword.value)
+                            for keyword in call.keywords
+                        }
+                    except (SyntaxError, ValueError) as e:
+                        self.status = TurnStatus.FAILED
+                        self.exception = TurnException(
+                            python_code=str(action_to_execute),
+                            exception=e,
+                        )
+                        raise e
+
+                logger.info(f"Executing {action.fn.__name__}({action_to_execute.args})")
+
+                context = {
+                    "page": self.browser_page.page,
+                    "id_to_xpath": self.browser_page.id_to_xpath,
+                }
+                if "processing_service" in inspect.signature(action.fn).parameters:
+                    context["processing_service"] = self.browser_page.processing_service
 
                 try:
-                    action.fn(
-                        *args,
-                        **kwargs,
-                        **{
-                            "page": self.browser_page.page,
-                            "id_to_xpath": self.browser_page.id_to_xpath,
-                        },
-                    )
+                    result = action.fn(*args, **kwargs, **context)
+                    if result:
+                        self.action_result = result
 
                     if any(
                         action.description == action_that_requires_wait.description
@@ -184,13 +349,12 @@ class Turn:
                             GoToUrlAction,
                         ]
                     ):
-                        time.sleep(5)
+                        time.sleep(ACTION_SETTLE_SECONDS)
                     else:
-                        cprint("NOT WAITING", "red")
-                        cprint(action, "red")
+                        logger.debug(f"Not waiting after {action.fn.__name__}")
                     self._handle_successful_execution()
                 except Exception as e:
-                    print(colored(e, "red"))
+                    logger.error(f"Action failed: {e}")
                     self.status = TurnStatus.FAILED
                     self.exception = TurnException(
                         python_code=str(action_to_execute),
@@ -212,25 +376,36 @@ class Turn:
 
     def _handle_successful_execution(self):
 
-        print(f"The current browser url is {self.browser_page.page.url}")
-        print(f"The previous browser url was {self.browser_page.url}")
+        current_page = active_page(self.browser_page.page)
+        logger.debug(
+            "Action executed",
+            extra={
+                "url": current_page.url,
+                "previous_url": self.browser_page.url,
+            },
+        )
 
-        if self.browser_page.page.url != self.browser_page.url:
-            cprint("NAVIGATED TO NEW PAGE")
+        if current_page.url != self.browser_page.url:
+            logger.info(f"Navigated to {current_page.url}")
             self.status = TurnStatus.NAVIGATED_TO_NEW_PAGE
 
             try:
-                new_html = self.browser_page.page.content()
                 old_html = self.browser_page.html
+                # Pages tracked by a DOMTracker have no html, their diff is taken
+                # from the regions at the next snapshot
+                new_html = current_page.content() if old_html else None
 
-                if old_html:
+                if old_html and self.browser_page.processing_service:
+                    self.html_diff = self.browser_page.processing_service.diff(
+                        old_html, new_html
+                    )
+                elif old_html:
                     sanit_1 = sanitize_html_for_diffing(old_html).prettify()
                     sanit_2 = sanitize_html_for_diffing(new_html).prettify()
                     self.html_diff = html_diff(sanit_1, sanit_2)
 
             except Exception as e:
-                cprint("Error calculating diff", e)
-                pass
+                logger.warning(f"Error calculating diff: {e}")
 
         else:
             self.status = TurnStatus.MODIFIED_PAGE
@@ -243,47 +418,166 @@ class Turn:
         llm_output: str,
         browser_page: BrowserPage,
     ):
+        actions_to_execute = cls.extract_actions_to_execute(
+            llm_output, available_actions
+        )
+        if not actions_to_execute:
+            raise LLMOutputParseError("Could not find an action to execute")
+
+        reasoning = cls.extract_reasoning(llm_output)
+
         turn = cls(
             prompt=prompt,
             available_actions=available_actions,
             llm_output=llm_output,
             observations=cls.extract_observations(llm_output),
-            reasoning=cls.extract_reasoning(llm_output),
-            action_description=cls.extract_action_description(llm_output),
-            actions_to_execute=cls.extract_actions_to_execute(llm_output),
+            reasoning=reasoning,
+            action_description=cls.extract_action_description(llm_output)
+            or reasoning
+            or str(actions_to_execute[0]),
+            actions_to_execute=actions_to_execute,
+            browser_page=browser_page,
+            status=TurnStatus.PENDING,
+        )
+
+        return turn
+
+    @classmethod
+    def construct_from_structured_output(
+        cls: Turn,
+        prompt: str,
+        available_actions: List[Action],
+        llm_output: StructuredLLMOutput,
+        browser_page: BrowserPage,
+    ):
+        text = llm_output.text
+        actions_to_execute = [
+            ActionToExecute.from_function_call(function_call.name, function_call.args)
+            for function_call in llm_output.function_calls
+        ]
+        if not actions_to_execute:
+            # The model answered in plain text, fall back to the strict parser
+            actions_to_execute = cls.extract_actions_to_execute(text, available_actions)
+        if not actions_to_execute:
+            raise LLMOutputParseError("Could not find an action to execute")
+
+        reasoning = cls._extract_section(text, "Reasoning", "Action") or text.strip()
+
+        turn = cls(
+            prompt=prompt,
+            available_actions=available_actions,
+            llm_output=str(llm_output),
+            observations=cls._extract_section(text, "Observations", "Reasoning"),
+            reasoning=reasoning,
+            action_description=cls.extract_action_description(text)
+            or reasoning
+            or str(actions_to_execute[0]),
+            actions_to_execute=actions_to_execute[:1],
             browser_page=browser_page,
             status=TurnStatus.PENDING,
         )
 
         return turn
 
+    @classmethod
+    def construct_from_macro_step(
+        cls: Turn,
+        available_actions: List[Action],
+        macro_step: MacroStep,
+        browser_page: BrowserPage,
+    ):
+        return cls(
+            prompt="",
+            available_actions=available_actions,
+            llm_output="",
+            observations="",
+            reasoning=f"Replaying a recorded step: {macro_step.action_description}",
+            action_description=macro_step.action_description,
+            actions_to_execute=[
+                ActionToExecute(
+                    action_name=macro_step.action_name,
+                    args=macro_step.args,
+                    kwargs=macro_step.kwargs,
+                )
+            ],
+            browser_page=browser_page,
+            status=TurnStatus.PENDING,
+        )
+
     @staticmethod
-    def extract_observations(llm_output: str):
-        pattern = r"Observations([\s\S]*)Reasoning"
+    def _extract_section(
+        llm_output: str, header: str, next_header: Optional[str]
+    ) -> Optional[str]:
+        # Headers look like "** Observations **", "Observations:" or "## Observations"
+        header_pattern = r"(?:^|\n)[#*\s]*{}\b[*\s]*:?[*\s]*"
+        pattern = header_pattern.format(header) + (
+            r"([\s\S]*?)" + header_pattern.format(next_header)
+            if next_header
+            else r"([\s\S]*)"
+        )
         match = re.search(pattern, llm_output)
         if match:
-            return match.group(1).strip()
+            return match.group(1).strip().strip("`").strip()
 
-        raise Exception("Could not find Observations")
+        return None
+
+    @staticmethod
+    def extract_observations(llm_output: str):
+        observations = Turn._extract_section(llm_output, "Observations", "Reasoning")
+        if observations is not None:
+            return observations
+
+        raise LLMOutputParseError("Could not find Observations")
 
     @staticmethod
     def extract_reasoning(llm_output: str):
-        pattern = r"Reasoning([\s\S]*)Action"
-        match = re.search(pattern, llm_output)
-        if match:
-            return match.group(1).strip()
+        reasoning = Turn._extract_section(llm_output, "Reasoning", "Action")
+        if reasoning is not None:
+            return reasoning
 
-        raise Exception("Could not find Reasoning")
+        raise LLMOutputParseError("Could not find Reasoning")
 
     @staticmethod
-    def extract_actions_to_execute(llm_output: str) -> List[ActionToExecute]:
-        pattern = r"\S+\(.*\)"
-        action_strings = re.findall(pattern, llm_output)
+    def extract_actions_to_execute(
+        llm_output: str, available_actions: Optional[List[Action]] = None
+    ) -> List[ActionToExecute]:
+        # Only look for calls in the Action section so that parentheticals in the
+        # observations or reasoning are not mistaken for actions
+        action_section = Turn._extract_section(llm_output, "Action", None)
+        if action_section is None:
+            action_section = llm_output
+
+        action_names = (
+            {action.fn.__name__ for action in available_actions}
+            if available_actions
+            else None
+        )
 
         actions_to_execute = []
-        for action_string in action_strings:
-            match = re.search(r"(\w+)\((.*)\)", action_string)
+        for line in action_section.splitlines():
+            line = line.strip().strip("`").strip()
+            # A call may follow prose on the same line ("I'll do it: f(x=1)") as
+            # long as it names one of the available actions
+            match = (
+                re.search(r"\b(\w+)\((.*)\)$", line)
+                if action_names is not None
+                else re.fullmatch(r"(\w+)\((.*)\)", line)
+            )
+            if not match:
+                continue
+
             action_name, args_str = match.groups()
+            if action_names is not None and action_name not in action_names:
+                continue
+
+            # The call must be a valid python call with literal arguments
+            try:
+                call = ast.parse(f"{action_name}({args_str})", mode="eval").body
+                for arg in call.args + [keyword.value for keyword in call.keywords]:
+                    ast.literal_eval(arg)
+            except (SyntaxError, ValueError):
+                continue
+
             actions_to_execute.append(
                 ActionToExecute(action_name=action_name, args=args_str)
             )
@@ -291,15 +585,16 @@ class Turn:
         return actions_to_execute
 
     @staticmethod
-    def extract_action_description(llm_output: str) -> str:
-        pattern = r"Action \*\*([\s\S]*)`"
-        match = re.search(pattern, llm_output)
-        if match:
-            return match.group(1).strip().replace("`", "")
-
-        return Turn.extract_reasoning(llm_output)  # TODO: Fix
+    def extract_action_description(llm_output: str) -> Optional[str]:
+        action_section = Turn._extract_section(llm_output, "Action", None)
+        if action_section is None:
+            return None
 
-        raise Exception("Could not find Action Description")
+        # The description is the text of the section without the call itself
+        description = re.sub(
+            r"`*\b\w+\(.*\)`*[ \t]*$", "", action_section, flags=re.MULTILINE
+        )
+        return " ".join(description.replace("`", "").split()) or None
 
     def stringify(self):
         if self.status == TurnStatus.FAILED:
@@ -317,6 +612,8 @@ class TurnStatus(Enum):
 @dataclass
 class TurnHistory:
     turns: List[Turn]
+    gemini_usage: GeminiUsage = field(default_factory=GeminiUsage)
+    call_llm: Callable[..., str] = call_gemini
 
     def save_turn(self, turn: Turn):
         self.turns.append(turn)
@@ -366,38 +663,93 @@ class TurnHistory:
         ):
             prompt = f"In a paragraph, concisely summarize the following actions taken by the user on a web browser. Address the user as 'you'. The user performed the following actions:\n{turn_history}\n\n Important: in your last sentence, you must describe the outcome of the most recent action based on webpage diff:\n{self.turns[-1].html_diff}"
 
-        cprint(prompt, "yellow")
+        logger.debug("Summary prompt", extra={"payload": prompt})
 
         time.sleep(1)
-        return call_gemini(
+        return self.call_llm(
             prompt=prompt,
-            gemini_usage=gemini_usage,
+            gemini_usage=self.gemini_usage,
         )
 
 
+class PageRepresentation(Enum):
+    HTML = "HTML"
+    ACCESSIBILITY_TREE = "accessibility tree"
+
+
+# Sites that are better described by their accessibility tree than their HTML
+PAGE_REPRESENTATION_BY_DOMAIN: Dict[str, PageRepresentation] = {}
+
+
+def page_representation_for_url(url: str) -> PageRepresentation:
+    domain = urlparse(url).netloc.lower()
+    for site, representation in PAGE_REPRESENTATION_BY_DOMAIN.items():
+        if domain == site or domain.endswith(f".{site}"):
+            return representation
+
+    return PageRepresentation.HTML
+
+
 @dataclass
 class BrowserPage:
     page: Page
     simplified_html: Optional[str]
     id_to_xpath: Optional[Dict[str, str]]
+    # None when a DOMTracker snapshots the page, which never fetches it whole
     html: Optional[str]
     url: Optional[str]
+    representation: PageRepresentation = PageRepresentation.HTML
+    processing_service: Optional[HTMLProcessingService] = None
+    # Diff of the regions that changed since the previous snapshot of the page
+    changes: Optional[str] = None
 
     @classmethod
-    def construct(cls: BrowserPage, page: Page) -> BrowserPage:
+    def construct(
+        cls: BrowserPage,
+        page: Page,
+        representation: Optional[PageRepresentation] = None,
+        processing_service: Optional[HTMLProcessingService] = None,
+        dom_tracker: Optional[DOMTracker] = None,
+    ) -> BrowserPage:
         if page.url == "about:blank":
             return cls(
-                page=page, simplified_html=None, id_to_xpath=None, html=None, url=None
+                page=page,
+                simplified_html=None,
+                id_to_xpath=None,
+                html=None,
+                url=None,
+                processing_service=processing_service,
             )
 
-        soup, id_to_xpath = simplify_html(page.content(), collapse_tags=True)
+        if representation is None:
+            representation = page_representation_for_url(page.url)
+
+        changes = None
+
+        if representation == PageRepresentation.ACCESSIBILITY_TREE:
+            html = page.content()
+            simplified_html, id_to_xpath = get_accessibility_tree(page)
+        elif dom_tracker:
+            # Only the regions that changed since the last snapshot are fetched
+            simplified_html, id_to_xpath, changes = dom_tracker.snapshot()
+            html = None
+        elif processing_service:
+            html = page.content()
+            simplified_html, id_to_xpath = processing_service.simplify(html)
+        else:
+            html = page.content()
+            soup, id_to_xpath = simplify_html(html, collapse_tags=True)
+            simplified_html = serialize_simplified_html(soup)
 
         return cls(
             page=page,
-            simplified_html=minify_html.minify(str(soup)),
+            simplified_html=simplified_html,
             id_to_xpath=id_to_xpath,
-            html=page.content(),
+            html=html,
             url=page.url,
+            representation=representation,
+            processing_service=processing_service,
+            changes=changes,
         )
 
 
@@ -410,18 +762,37 @@ def format_action_for_prompt(action: Action):
     params = [
         param
         for param in signature.parameters.values()
-        if param.name not in ["page", "id_to_xpath"]
+        if param.name not in ["page", "id_to_xpath", "processing_service"]
     ]
     param_str = ", ".join(str(param) for param in params)
 
     return f"{action.fn.__name__}({param_str}): {action.description}"
 
 
+def format_action_as_function_declaration(action: Action) -> Dict[str, Any]:
+    schema = action.args.model_json_schema()
+    properties = schema["properties"]
+    for v in properties.values():
+        v.pop("title", None)
+
+    return {
+        "name": action.fn.__name__,
+        "description": action.description,
+        "parameters": {
+            "type": "object",
+            "properties": properties,
+            "required": schema.get("required", []),
+        },
+    }
+
+
 def fmt_browser_agent_prompt(
     task: str,
     available_actions: List[Action],
     turn_history: TurnHistory,
     browser_page: BrowserPage,
+    structured_output: bool = False,
+    summarized_actions: Optional[str] = None,
 ):
 
     formatted_actions = "\n".join(
@@ -433,7 +804,13 @@ def fmt_browser_agent_prompt(
         )
     ]
 
-    summarized_actions = turn_history.summarize_actions()
+    if summarized_actions is None:
+        summarized_actions = turn_history.summarize_actions()
+
+    if turn_history.turns and turn_history.turns[-1].action_result:
+        prompt.append(
+            f"The action you performed in the previous turn returned:\n{turn_history.turns[-1].action_result}"
+        )
 
     if turn_history.turns and turn_history.turns[-1].status == TurnStatus.FAILED:
         failed_turn = turn_history.turns[-1]
@@ -461,6 +838,12 @@ def fmt_browser_agent_prompt(
         ```"""
     )
 
+    if structured_output:
+        prompt[-1] = prompt[-1].replace(
+            'Then, in a new line, call the action in the following format: action_name(param_name="argument")',
+            "Then, call exactly one of the provided functions to perform the action.",
+        )
+
     """
     For example, a real response for a different task to book a Delta plane ticket is below:
     '''
@@ -475,7 +858,16 @@ def fmt_browser_agent_prompt(
     #         f"So far, you have already performed the following actions on the page:\n{turn_history.current_page_actions[1]}"
     #     )
 
-    if browser_page.page.url != "about:blank":
+    if (
+        browser_page.page.url != "about:blank"
+        and browser_page.representation == PageRepresentation.ACCESSIBILITY_TREE
+    ):
+        prompt.append(
+            f"The webpage {browser_page.page.url} is open. Instead of HTML, the webpage is described by its accessibility tree: each line is an element's role, followed by its name, value and states, and elements you can act on are prefixed by their [id]. Carefully analyze the accessibility tree, and based on its contents, determine the next action to take to help the user get closer to achieving their task. The accessibility tree of the current webpage is:\n```"
+            + browser_page.simplified_html
+            + "\n```"
+        )
+    elif browser_page.page.url != "about:blank":
         prompt.append(
             f"The webpage {browser_page.page.url} is open. Carefully analyze the HTML, and based on the HTML contents, determine the next action to take to help the user get closer to achieving their task. The HTML of the current webpage is:\n```"
             + browser_page.simplified_html
@@ -493,42 +885,327 @@ def fmt_browser_agent_prompt(
     return "\n\n".join(textwrap.dedent(text) for text in prompt)
 
 
-with sync_playwright() as playwright:
-    chromium = playwright.chromium
-    browser = chromium.launch(headless=False)
-    page = browser.new_page()
-    page.set_default_timeout(5000)
-    turn_history = TurnHistory(turns=[])
-    gemini_usage = GeminiUsage()
-
-    for i in range(50):
-        available_actions = [
-            ClickElementByIdAction,
-            FillTextByIdAction,
-            SelectOptionsByIdAction,
-            GoToUrlAction,
-        ]
-        print(f"-------------Action {i}-----------------")
-        browser_page = BrowserPage.construct(page=page)
-        prompt = fmt_browser_agent_prompt(
-            task="Order a large Pepperoni Pizza from Dominos delivered to 75 Harrison St, San Francisco 94107",
-            available_actions=available_actions,
-            turn_history=turn_history,
-            browser_page=browser_page,
-        )
-        print(f"Prompt:\n{prompt}")
+@dataclass
+class AgentRunResult:
+    task: str
+    turns: int
+    failed_turns: int
+    replayed_turns: int
+    parse_failures: int
+    # Whether the task was completed, by `is_task_done` or else by the LLM
+    # calling finish_task
+    task_done: bool
+    final_url: Optional[str]
+    gemini_usage: GeminiUsage
+    duration_seconds: float
+    # Seconds spent in each stage of each turn
+    stage_timings: List[Dict[str, float]] = field(default_factory=list)
+
+
+@contextmanager
+def timed(timings: Dict[str, float], stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 3)
+
+
+def summarize_actions_in_background(
+    executor: ThreadPoolExecutor, turn_history: TurnHistory
+) -> Future:
+    # Only the turns before the one just dispatched have their status and diff
+    # set, the latest turn is still executing while the summary runs
+    completed_history = TurnHistory(
+        turns=turn_history.turns[:-1],
+        gemini_usage=turn_history.gemini_usage,
+        call_llm=turn_history.call_llm,
+    )
 
-        llm_output = call_gemini(prompt, gemini_usage=gemini_usage)
-        # llm_output = call_openai(prompt)
+    def summarize():
+        timings = {}
+        with timed(timings, "summary"):
+            summarized_actions = completed_history.summarize_actions()
+        return summarized_actions, timings["summary"]
 
-        cprint(f"\n\nLLM Output:\n{llm_output}", "green")
+    # Copy the context so the summary is logged with the agent and turn
+    return executor.submit(contextvars.copy_context().run, summarize)
 
-        turn: Turn = Turn.construct(prompt, available_actions, llm_output, browser_page)
-        turn_history.save_turn(turn)
+
+def run_agent(
+    task: str,
+    max_turns: int = 50,
+    headless: bool = False,
+    structured_output: bool = True,
+    pipelined: bool = True,
+    on_turn: Optional[Callable[[int], None]] = None,
+    is_task_done: Optional[Callable[[], bool]] = None,
+    representation: Optional[PageRepresentation] = None,
+    macro_store: Optional[MacroStore] = None,
+    call_llm: Callable[..., str] = call_gemini,
+    call_llm_with_tools: Callable[..., StructuredLLMOutput] = call_gemini_with_tools,
+) -> AgentRunResult:
+    """
+    When `pipelined`, the history summary (an LLM call) for the next turn is
+    started as soon as an action is dispatched, and runs while the action
+    executes, the page settles and the next snapshot is simplified. It covers
+    the turns that completed before that action, and the action itself is
+    added to the prompt as written once it succeeded. Replayed macro steps
+    don't start a summary, the next LLM turn summarizes them when it needs to.
+
+    The run stops early once `is_task_done` returns True, or when it isn't
+    given, once the LLM calls finish_task. Only flows from runs that completed
+    the task are replayed on later runs. `call_llm` and
+    `call_llm_with_tools` replace the Gemini calls, e.g. with a `MockLLM`.
+    """
+    start_time = time.time()
+
+    with sync_playwright() as playwright:
+        chromium = playwright.chromium
+        browser = chromium.launch(headless=headless)
+        # explore_links opens tabs through the context, which pages made with
+        # browser.new_page() do not allow
+        page = browser.new_context().new_page()
+        page.set_default_timeout(5000)
+        processing_service = HTMLProcessingService()
+        dom_tracker = DOMTracker(page, processing_service=processing_service)
+        gemini_usage = GeminiUsage()
+        turn_history = TurnHistory(
+            turns=[], gemini_usage=gemini_usage, call_llm=call_llm
+        )
+        # Flows learned on previous runs of the task are replayed without the LLM
+        if macro_store is None:
+            macro_store = MacroStore()
+        macro_replay: Optional[MacroReplay] = None
+        # How far each domain's flow got, so that a flow never replays a step
+        # twice in one run
+        replay_positions: Dict[str, int] = {}
+        # Pages where a replayed step failed, the LLM takes over on them
+        failed_fingerprints: Set[str] = set()
+        finished = False
+        replayed_turns = 0
+        parse_failures = 0
+        stage_timings: List[Dict[str, float]] = []
+        # The playwright sync api is bound to this thread, so only the summary
+        # LLM call is moved to a background thread
+        summary_executor = ThreadPoolExecutor(max_workers=1)
+        summary_future: Optional[Future] = None
 
         try:
-            turn.execute_actions()
-        except Exception as e:
-            pass
+            for i in range(max_turns):
+                if is_task_done() if is_task_done else finished:
+                    logger.info("Task done")
+                    break
+                if on_turn:
+                    on_turn(i)
+
+                timings: Dict[str, float] = {}
+                stage_timings.append(timings)
+
+                available_actions = [
+                    ClickElementByIdAction,
+                    FillTextByIdAction,
+                    SelectOptionsByIdAction,
+                    GoToUrlAction,
+                    ExploreLinksAction,
+                    ChooseExploredTabAction,
+                    FinishTaskAction,
+                ]
+                set_log_context(turn=i)
+                page = active_page(page)
+                if dom_tracker.page != page:
+                    dom_tracker = DOMTracker(
+                        page, processing_service=processing_service
+                    )
+                with timed(timings, "snapshot"):
+                    browser_page = BrowserPage.construct(
+                        page=page,
+                        representation=representation,
+                        processing_service=processing_service,
+                        dom_tracker=dom_tracker,
+                    )
+
+                # The region diff describes the outcome of the previous action on
+                # pages tracked by the DOMTracker
+                if (
+                    turn_history.turns
+                    and turn_history.turns[-1].status
+                    in (TurnStatus.MODIFIED_PAGE, TurnStatus.NAVIGATED_TO_NEW_PAGE)
+                    and turn_history.turns[-1].html_diff is None
+                ):
+                    turn_history.turns[-1].html_diff = browser_page.changes
+
+                domain = page_domain(browser_page.url)
+                if (
+                    macro_replay is not None
+                    and macro_replay.exhausted
+                    and domain != macro_replay.domain
+                ):
+                    # The flow for the previous domain finished, continue with
+                    # the flow recorded for this one
+                    macro_replay = None
+                if macro_replay is None:
+                    macro_replay = macro_store.start_replay(
+                        task,
+                        browser_page,
+                        start=replay_positions.get(domain, 0),
+                        skip_fingerprints=failed_fingerprints,
+                    )
+                macro_step = (
+                    macro_replay.next_step(browser_page) if macro_replay else None
+                )
+                if macro_step is None:
+                    macro_replay = None
+                else:
+                    replay_positions[macro_replay.domain] = macro_replay.position
+
+                if macro_step is not None:
+                    logger.info(f"Replaying recorded step: {macro_step.action_name}")
+                    turn: Turn = Turn.construct_from_macro_step(
+                        available_actions, macro_step, browser_page
+                    )
+                    turn_history.save_turn(turn)
+                    replayed_turns += 1
+                    # A pending summary doesn't cover this turn, so the next LLM
+                    # turn summarizes the whole history itself
+                    summary_future = None
+                    try:
+                        with timed(timings, "execute"):
+                            turn.execute_actions()
+                    except Exception as e:
+                        failed_fingerprints.add(macro_step.fingerprint)
+                        macro_replay = None
+                    continue
+
+                summarized_actions = None
+                if summary_future is not None:
+                    with timed(timings, "summary_wait"):
+                        summarized_actions, timings["summary"] = summary_future.result()
+
+                    latest_turn = turn_history.turns[-1]
+                    if latest_turn.status != TurnStatus.FAILED:
+                        summarized_actions = " ".join(
+                            part
+                            for part in [
+                                summarized_actions,
+                                f"Most recently, you performed this action: {latest_turn.action_description}",
+                            ]
+                            if part
+                        )
+                    # An empty history reads as "None" in the prompt, the same as
+                    # when fmt_browser_agent_prompt summarizes it
+                    summarized_actions = str(summarized_actions)
+
+                with timed(timings, "prompt"):
+                    prompt = fmt_browser_agent_prompt(
+                        task=task,
+                        available_actions=available_actions,
+                        turn_history=turn_history,
+                        browser_page=browser_page,
+                        structured_output=structured_output,
+                        summarized_actions=summarized_actions,
+                    )
+                logger.debug("Prompt", extra={"payload": prompt})
+
+                # Errors from the LLM call itself are not parse failures and end
+                # the run
+                with timed(timings, "llm"):
+                    if structured_output:
+                        llm_output = call_llm_with_tools(
+                            prompt,
+                            [
+                                format_action_as_function_declaration(action)
+                                for action in available_actions
+                            ],
+                            gemini_usage=gemini_usage,
+                        )
+                        logger.debug("LLM output", extra={"payload": str(llm_output)})
+                    else:
+                        llm_output = call_llm(prompt, gemini_usage=gemini_usage)
+                        # llm_output = call_openai(prompt)
+                        logger.debug("LLM output", extra={"payload": llm_output})
+
+                try:
+                    if structured_output:
+                        turn: Turn = Turn.construct_from_structured_output(
+                            prompt, available_actions, llm_output, browser_page
+                        )
+                    else:
+                        turn: Turn = Turn.construct(
+                            prompt, available_actions, llm_output, browser_page
+                        )
+                except LLMOutputParseError as e:
+                    parse_failures += 1
+                    logger.warning(
+                        f"Could not parse LLM output: {e}",
+                        extra={"parse_failures": parse_failures},
+                    )
+                    continue
+
+                turn_history.save_turn(turn)
+                if pipelined:
+                    summary_future = summarize_actions_in_background(
+                        summary_executor, turn_history
+                    )
+
+                try:
+                    with timed(timings, "execute"):
+                        turn.execute_actions()
+                except Exception as e:
+                    pass
+                finally:
+                    logger.info("Turn timings", extra={"stage_timings": timings})
+
+                if (
+                    turn.status != TurnStatus.FAILED
+                    and turn.actions_to_execute[0].action_name
+                    == FinishTaskAction.fn.__name__
+                ):
+                    logger.info("The LLM finished the task")
+                    finished = True
+
+            task_done = is_task_done() if is_task_done else finished
+            macro_store.record(
+                task,
+                [
+                    MacroStep.from_turn(turn)
+                    for turn in turn_history.turns
+                    if turn.status
+                    in (TurnStatus.MODIFIED_PAGE, TurnStatus.NAVIGATED_TO_NEW_PAGE)
+                    and turn.actions_to_execute[0].action_name
+                    != FinishTaskAction.fn.__name__
+                ],
+                verified=task_done,
+            )
+
+            final_url = active_page(page).url
+        finally:
+            summary_executor.shutdown(wait=False, cancel_futures=True)
+            processing_service.shutdown()
+            browser.close()
+
+    return AgentRunResult(
+        task=task,
+        turns=len(stage_timings),
+        failed_turns=sum(
+            turn.status == TurnStatus.FAILED for turn in turn_history.turns
+        ),
+        replayed_turns=replayed_turns,
+        parse_failures=parse_failures,
+        task_done=task_done,
+        final_url=final_url,
+        gemini_usage=gemini_usage,
+        duration_seconds=time.time() - start_time,
+        stage_timings=stage_timings,
+    )
+
+
+if __name__ == "__main__":
+    configure_logging()
+    set_log_context(agent="agent-0")
+
+    run_agent(
+        task="Order a large Pepperoni Pizza from Dominos delivered to 75 Harrison St, San Francisco 94107"
+    )
 
-    browser.close()
+    shutdown_logging()
@@ -0,0 +1,179 @@
+import contextvars
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from contextlib import contextmanager
+from typing import Optional
+from termcolor import colored
+
+logger = logging.getLogger("agent")
+
+# Fields such as the agent id and turn number that are attached to every record
+_log_context: contextvars.ContextVar[dict] = contextvars.ContextVar(
+    "log_context", default={}
+)
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+LEVEL_COLORS = {
+    logging.DEBUG: "grey",
+    logging.INFO: "green",
+    logging.WARNING: "yellow",
+    logging.ERROR: "red",
+    logging.CRITICAL: "red",
+}
+
+# Record attributes that are not worth writing to the log file
+_RECORD_ATTRS = set(logging.LogRecord("", 0, "", 0, "", None, None).__dict__.keys()) | {
+    "message",
+    "context",
+    "payload",
+}
+
+
+def set_log_context(**fields):
+    _log_context.set({**_log_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    # Runs on the calling thread, so the context is captured at the time of the call
+    def filter(self, record):
+        record.context = _log_context.get()
+        return True
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stdlib handler formats the message on the calling thread. Records
+        # only carry str()-able payloads, so pass them through untouched and
+        # let the listener do all of the formatting.
+        return record
+
+
+class JSONLFormatter(logging.Formatter):
+    """
+    One json object per line. Payloads (prompts, llm outputs, diffs) larger than
+    `payload_threshold` characters are written once to `payload_dir`, named by
+    their hash, and only referenced from the log line.
+    """
+
+    def __init__(self, payload_dir: str, payload_threshold: int = 2048):
+        super().__init__()
+        self.payload_dir = payload_dir
+        self.payload_threshold = payload_threshold
+        os.makedirs(payload_dir, exist_ok=True)
+
+    def _store_payload(self, payload: str) -> str:
+        digest = hashlib.sha1(payload.encode("utf-8")).hexdigest()
+        path = os.path.join(self.payload_dir, f"{digest}.txt")
+        if not os.path.exists(path):
+            with open(path, "w") as f:
+                f.write(payload)
+        return path
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            **getattr(record, "context", {}),
+        }
+        entry.update(
+            {
+                key: value
+                for key, value in record.__dict__.items()
+                if key not in _RECORD_ATTRS
+            }
+        )
+
+        payload = getattr(record, "payload", None)
+        if payload is not None:
+            payload = str(payload)
+            if len(payload) > self.payload_threshold:
+                entry["payload_ref"] = self._store_payload(payload)
+                entry["payload_chars"] = len(payload)
+            else:
+                entry["payload"] = payload
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, default=str)
+
+
+class ConsoleFormatter(logging.Formatter):
+    # Payloads only go to the log file, the console gets the one line message
+    def format(self, record):
+        context = getattr(record, "context", {})
+        prefix = " ".join(f"[{key}={value}]" for key, value in context.items())
+        message = f"{prefix} {record.getMessage()}" if prefix else record.getMessage()
+        return colored(message, LEVEL_COLORS.get(record.levelno, "white"))
+
+
+def configure_logging(
+    log_dir: str = "logs",
+    level: int = logging.DEBUG,
+    console_level: int = logging.INFO,
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 5,
+    payload_threshold: int = 2048,
+):
+    """
+    Route the "agent" logger through an in-memory queue. A background listener
+    thread formats the records and writes them to a rotating jsonl file and the
+    console, so logging never blocks the agent loop on I/O.
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    os.makedirs(log_dir, exist_ok=True)
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, "agent.jsonl"),
+        maxBytes=max_bytes,
+        backupCount=backup_count,
+    )
+    file_handler.setFormatter(
+        JSONLFormatter(
+            payload_dir=os.path.join(log_dir, "payloads"),
+            payload_threshold=payload_threshold,
+        )
+    )
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+    console_handler.setFormatter(ConsoleFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    logger.setLevel(level)
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _listener.start()
+
+
+def shutdown_logging():
+    global _listener
+    if _listener is not None:
+        # Flushes everything still in the queue
+        _listener.stop()
+        _listener = None
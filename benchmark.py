@@ -0,0 +1,366 @@
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from termcolor import cprint
+import agent
+from agent import (
+    AgentRunResult,
+    ClickElementByIdAction,
+    FillTextByIdAction,
+    GoToUrlAction,
+    PageRepresentation,
+    SelectOptionsByIdAction,
+    run_agent,
+)
+from agent_logging import configure_logging, log_context, shutdown_logging
+from compare_page_representations import CHARS_PER_TOKEN
+from llm import FunctionCall, MockLLM, StructuredLLMOutput
+from macros import MacroStore
+from mock_storefront import CartItem, MockStorefront, Order
+
+PIZZA = "pepperoni"
+SIZE = "large"
+STREET = "75 Harrison St"
+CITY = "San Francisco"
+ZIP = "94107"
+
+REPRESENTATIONS = {
+    "html": PageRepresentation.HTML,
+    "ax": PageRepresentation.ACCESSIBILITY_TREE,
+}
+
+# Written by fmt_browser_agent_prompt when the previous action raised
+FAILED_ACTION_MARKER = "you tried to perform the following action and it failed"
+SUMMARY_PROMPT_PREFIX = "In a paragraph, concisely summarize"
+
+
+def find_element_id(prompt: str, label: str) -> Optional[str]:
+    """
+    Find the id of the element whose text or attributes contain `label`, in
+    either page representation.
+    """
+    # Accessibility tree lines look like: [4] button "Add Pepperoni to cart"
+    for match in re.finditer(r'\[(\w+)\] \w+ "([^"\n]*)"', prompt):
+        if label in match.group(2):
+            return match.group(1)
+
+    # Simplified html looks like: <button id=4>Add Pepperoni to cart</button>
+    for match in re.finditer(r"<\w+([^<>]*)>([^<]*)", prompt):
+        attrs, text = match.groups()
+        id_match = re.search(r'(?:^|\s)id=(?:"([^"]*)"|([^\s>]+))', attrs)
+        if id_match and (label in attrs or label in text):
+            return id_match.group(1) or id_match.group(2)
+
+    return None
+
+
+@dataclass
+class ScriptedStep:
+    action_name: str
+    args: Dict[str, Any]
+    description: str
+    # Text of the element to act on, its id is looked up in the prompt
+    label: Optional[str] = None
+
+
+def storefront_steps(url: str) -> List[ScriptedStep]:
+    click = ClickElementByIdAction.fn.__name__
+    fill = FillTextByIdAction.fn.__name__
+    return [
+        ScriptedStep(GoToUrlAction.fn.__name__, {"url": url}, "Open the pizza store"),
+        ScriptedStep(fill, {"text": STREET}, "Enter the street", "Street address"),
+        ScriptedStep(fill, {"text": CITY}, "Enter the city", "City"),
+        ScriptedStep(fill, {"text": ZIP}, "Enter the ZIP code", "ZIP code"),
+        ScriptedStep(click, {}, "Start the order", "Start your order"),
+        ScriptedStep(
+            SelectOptionsByIdAction.fn.__name__,
+            {"values": [SIZE]},
+            "Choose a large pepperoni",
+            "Pepperoni size",
+        ),
+        ScriptedStep(click, {}, "Add the pizza to the cart", "Add Pepperoni to cart"),
+        ScriptedStep(click, {}, "Open the cart", "Cart ("),
+        ScriptedStep(click, {}, "Go to checkout", "Checkout"),
+        ScriptedStep(click, {}, "Place the order", "Place order"),
+    ]
+
+
+class StorefrontScript:
+    """
+    Plays the LLM for the storefront task. Each action prompt gets the next
+    step, with the element id read from the page in the prompt. The step is
+    repeated if the prompt reports that it failed, and like a real model that
+    can't find the element, it answers without an action when the element is
+    missing from the page representation.
+    """
+
+    def __init__(self, steps: List[ScriptedStep]):
+        self.steps = steps
+        self.position = 0
+        self.awaiting_outcome = False
+
+    def respond(
+        self, prompt: str, function_declarations: Optional[List[Dict[str, Any]]]
+    ) -> StructuredLLMOutput:
+        if prompt.startswith(SUMMARY_PROMPT_PREFIX):
+            action_count = len(re.findall(r"^\d+\. ", prompt, flags=re.MULTILINE))
+            return StructuredLLMOutput(
+                text=f"You have taken {action_count} actions towards your order."
+            )
+
+        if self.awaiting_outcome and FAILED_ACTION_MARKER not in prompt:
+            self.position += 1
+        self.awaiting_outcome = False
+
+        if self.position >= len(self.steps):
+            return StructuredLLMOutput(
+                text="** Observations **\nThe order has been placed.\n** Reasoning **\nThere is nothing left to do.\n** Action **\nNone"
+            )
+
+        step = self.steps[self.position]
+        args = dict(step.args)
+        if step.label is not None:
+            element_id = find_element_id(prompt, step.label)
+            if element_id is None:
+                return StructuredLLMOutput(
+                    text=f"** Observations **\nI can't find '{step.label}' on the page.\n** Reasoning **\nI need to find it before I can continue.\n** Action **\nNone"
+                )
+            args = {"id": element_id, **args}
+
+        self.awaiting_outcome = True
+        return StructuredLLMOutput(
+            text=f"** Observations **\nThis is the pizza store.\n** Reasoning **\nThe next step of the order is to {step.description.lower()}.\n** Action **\n{step.description}",
+            function_calls=[FunctionCall(name=step.action_name, args=args)],
+        )
+
+
+def order_matches(order: Order) -> bool:
+    return (
+        order.items == [CartItem(pizza=PIZZA, size=SIZE)]
+        and order.address.street.strip().lower() == STREET.lower()
+        and order.address.zip.strip() == ZIP
+    )
+
+
+@dataclass
+class BenchmarkConfig:
+    representation: PageRepresentation
+    structured_output: bool
+    pipelined: bool
+
+    @property
+    def name(self) -> str:
+        return "/".join(
+            [
+                (
+                    "ax"
+                    if self.representation == PageRepresentation.ACCESSIBILITY_TREE
+                    else "html"
+                ),
+                "structured" if self.structured_output else "text",
+                "pipelined" if self.pipelined else "serial",
+            ]
+        )
+
+
+def run_task(
+    storefront: MockStorefront,
+    config: BenchmarkConfig,
+    max_turns: int,
+    latency: float,
+    latency_per_1k_chars: float,
+    headless: bool,
+) -> Tuple[bool, AgentRunResult]:
+    storefront.reset()
+    script = StorefrontScript(storefront_steps(storefront.url))
+    mock_llm = MockLLM(
+        script.respond, latency=latency, latency_per_1k_chars=latency_per_1k_chars
+    )
+
+    # A fresh macro store, so that runs don't replay each other's flows
+    with tempfile.TemporaryDirectory() as macro_dir:
+        agent_run_result = run_agent(
+            task=f"Order a {SIZE} {PIZZA.capitalize()} Pizza from {storefront.url} delivered to {STREET}, {CITY} {ZIP}",
+            max_turns=max_turns,
+            headless=headless,
+            structured_output=config.structured_output,
+            pipelined=config.pipelined,
+            is_task_done=storefront.has_order,
+            representation=config.representation,
+            macro_store=MacroStore(os.path.join(macro_dir, "macros.json")),
+            call_llm=mock_llm.call_gemini,
+            call_llm_with_tools=mock_llm.call_gemini_with_tools,
+        )
+
+    success = any(order_matches(order) for order in storefront.orders)
+    return success, agent_run_result
+
+
+def summarize_runs(
+    build: str,
+    config: BenchmarkConfig,
+    runs: List[Tuple[bool, AgentRunResult]],
+) -> Dict[str, Any]:
+    results = [agent_run_result for _, agent_run_result in runs]
+    turns = sum(result.turns for result in results)
+    chars = sum(
+        result.gemini_usage.input_char_count + result.gemini_usage.output_char_count
+        for result in results
+    )
+
+    stage_seconds: Dict[str, float] = {}
+    for result in results:
+        for timings in result.stage_timings:
+            for stage, seconds in timings.items():
+                stage_seconds[stage] = stage_seconds.get(stage, 0) + seconds
+
+    return {
+        "build": build,
+        "config": config.name,
+        "runs": len(runs),
+        "success_rate": sum(success for success, _ in runs) / len(runs),
+        "turns_per_task": turns / len(runs),
+        "seconds_per_turn": sum(result.duration_seconds for result in results)
+        / max(turns, 1),
+        "tokens_per_turn": chars / CHARS_PER_TOKEN / max(turns, 1),
+        "cost_per_task": sum(result.gemini_usage.total_cost for result in results)
+        / len(runs),
+        "parse_failures_per_task": sum(result.parse_failures for result in results)
+        / len(runs),
+        "failed_turns_per_task": sum(result.failed_turns for result in results)
+        / len(runs),
+        "stage_seconds_per_turn": {
+            stage: round(seconds / max(turns, 1), 3)
+            for stage, seconds in stage_seconds.items()
+        },
+        "time": time.time(),
+    }
+
+
+def print_report(rows: List[Dict[str, Any]]):
+    cprint(
+        f"{'build':<14} {'config':<26} {'success':>8} {'turns/task':>11} {'s/turn':>7} {'tokens/turn':>12} {'$/task':>8}",
+        "blue",
+    )
+    for row in rows:
+        print(
+            f"{row['build']:<14} {row['config']:<26} {row['success_rate']:>8.0%} {row['turns_per_task']:>11.1f} {row['seconds_per_turn']:>7.2f} {row['tokens_per_turn']:>12.0f} {row['cost_per_task']:>8.4f}"
+        )
+
+
+def current_build() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the agent loop end to end on a local mock storefront with a mock LLM"
+    )
+    parser.add_argument(
+        "--build", help="Label for the results, the git revision by default"
+    )
+    parser.add_argument("--runs", type=int, default=3, help="Tasks per config")
+    parser.add_argument("--max-turns", type=int, default=20)
+    parser.add_argument(
+        "--representations",
+        nargs="+",
+        choices=list(REPRESENTATIONS),
+        default=list(REPRESENTATIONS),
+    )
+    parser.add_argument(
+        "--output-modes",
+        nargs="+",
+        choices=["structured", "text"],
+        default=["structured"],
+    )
+    parser.add_argument(
+        "--pipeline", nargs="+", choices=["on", "off"], default=["on", "off"]
+    )
+    parser.add_argument(
+        "--latency", type=float, default=1.0, help="Seconds per mock LLM call"
+    )
+    parser.add_argument(
+        "--latency-per-1k-chars",
+        type=float,
+        default=0.01,
+        help="Extra seconds per mock LLM call for every 1000 prompt characters",
+    )
+    parser.add_argument(
+        "--settle-seconds",
+        type=float,
+        default=agent.ACTION_SETTLE_SECONDS,
+        help="Seconds to wait after a click or navigation",
+    )
+    parser.add_argument("--headed", action="store_true")
+    parser.add_argument(
+        "--results",
+        default="benchmark_results.jsonl",
+        help="File that every result row is appended to",
+    )
+    args = parser.parse_args()
+
+    build = args.build or current_build()
+    agent.ACTION_SETTLE_SECONDS = args.settle_seconds
+
+    configs = [
+        BenchmarkConfig(
+            representation=REPRESENTATIONS[representation],
+            structured_output=output_mode == "structured",
+            pipelined=pipeline == "on",
+        )
+        for representation, output_mode, pipeline in itertools.product(
+            args.representations, args.output_modes, args.pipeline
+        )
+    ]
+
+    configure_logging(log_dir="logs/benchmark", console_level=logging.WARNING)
+    storefront = MockStorefront()
+    storefront.start()
+
+    rows = []
+    try:
+        for config in configs:
+            runs = []
+            for run in range(args.runs):
+                with log_context(agent="benchmark", config=config.name, run=run):
+                    runs.append(
+                        run_task(
+                            storefront,
+                            config,
+                            max_turns=args.max_turns,
+                            latency=args.latency,
+                            latency_per_1k_chars=args.latency_per_1k_chars,
+                            headless=not args.headed,
+                        )
+                    )
+
+            row = summarize_runs(build, config, runs)
+            rows.append(row)
+            with open(args.results, "a") as f:
+                f.write(json.dumps(row) + "\n")
+    finally:
+        storefront.stop()
+        shutdown_logging()
+
+    print_report(rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+import sys
+import time
+from playwright.sync_api import sync_playwright
+from termcolor import cprint
+from webpage import serialize_simplified_html, simplify_html
+from accessibility import get_accessibility_tree
+
+# Rough conversion used for reporting, Gemini bills by character
+CHARS_PER_TOKEN = 4
+
+DEFAULT_URLS = [
+    "https://www.dominos.com",
+    "https://www.dominos.com/en/pages/order/",
+]
+
+
+def compare_page_representations(urls):
+    rows = []
+    with sync_playwright() as playwright:
+        browser = playwright.chromium.launch(headless=True)
+        page = browser.new_page()
+        page.set_default_timeout(15000)
+
+        for url in urls:
+            page.goto(url)
+            time.sleep(5)
+
+            soup, html_id_to_xpath = simplify_html(page.content(), collapse_tags=True)
+            html_text = serialize_simplified_html(soup)
+            ax_text, ax_id_to_xpath = get_accessibility_tree(page)
+
+            rows.append(
+                (
+                    url,
+                    len(html_text),
+                    len(ax_text),
+                    len(html_id_to_xpath),
+                    len(ax_id_to_xpath),
+                )
+            )
+
+        browser.close()
+
+    cprint(
+        f"{'url':<50} {'html tokens':>12} {'ax tokens':>10} {'ratio':>6} {'html ids':>9} {'ax ids':>7}",
+        "blue",
+    )
+    for url, html_chars, ax_chars, html_ids, ax_ids in rows:
+        ratio = html_chars / ax_chars if ax_chars else float("inf")
+        print(
+            f"{url:<50} {html_chars // CHARS_PER_TOKEN:>12} {ax_chars // CHARS_PER_TOKEN:>10} {ratio:>6.1f} {html_ids:>9} {ax_ids:>7}"
+        )
+
+    return rows
+
+
+if __name__ == "__main__":
+    compare_page_representations(sys.argv[1:] or DEFAULT_URLS)
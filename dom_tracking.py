@@ -0,0 +1,265 @@
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from bs4 import BeautifulSoup
+from playwright.sync_api import Page
+from html_processing import HTMLProcessingService
+from webpage import (
+    compact_element_ids,
+    html_diff,
+    sanitize_html_for_diffing,
+    serialize_simplified_html,
+    simplify_html,
+)
+
+# Regions with more descendant elements than this are split into their children
+MAX_REGION_SIZE = 300
+
+# Installed in every document. The body is partitioned into regions tagged with
+# data-agent-region, and a MutationObserver records which regions changed since
+# the last snapshot. Mutations outside of any region force a full snapshot.
+TRACKER_SCRIPT = """
+(() => {
+    if (window.__agentTracker) return;
+
+    const REGION_ATTR = "data-agent-region";
+
+    const xpathOf = (el) => {
+        const segments = [];
+        for (; el && el.nodeType === Node.ELEMENT_NODE; el = el.parentElement) {
+            const name = el.localName;
+            const siblings = el.parentElement
+                ? [...el.parentElement.children].filter((sib) => sib.localName === name)
+                : [el];
+            segments.unshift(
+                siblings.length > 1 ? `${name}[${siblings.indexOf(el) + 1}]` : name
+            );
+        }
+        return "/" + segments.join("/");
+    };
+
+    const hasOwnText = (el) =>
+        [...el.childNodes].some(
+            (node) => node.nodeType === Node.TEXT_NODE && node.textContent.trim()
+        );
+
+    const tracker = {
+        nextRegionId: 1,
+        dirty: new Set(),
+        full: true,
+
+        partition(maxRegionSize) {
+            document
+                .querySelectorAll(`[${REGION_ATTR}]`)
+                .forEach((el) => el.removeAttribute(REGION_ATTR));
+            const stack = [...document.body.children].reverse();
+            while (stack.length) {
+                const el = stack.pop();
+                const size = el.getElementsByTagName("*").length;
+                if (size > maxRegionSize && el.children.length && !hasOwnText(el)) {
+                    stack.push(...[...el.children].reverse());
+                } else {
+                    el.setAttribute(REGION_ATTR, String(this.nextRegionId++));
+                }
+            }
+        },
+
+        collect(maxRegionSize) {
+            if (!document.body) return { full: true, url: location.href, order: [], dirty: [] };
+            const full = this.full || !document.body.querySelector(`[${REGION_ATTR}]`);
+            if (full) this.partition(maxRegionSize);
+
+            const regions = [...document.querySelectorAll(`[${REGION_ATTR}]`)];
+            const snapshot = {
+                full,
+                url: location.href,
+                order: regions.map((el) => el.getAttribute(REGION_ATTR)),
+                dirty: regions
+                    .filter((el) => full || this.dirty.has(el.getAttribute(REGION_ATTR)))
+                    .map((el) => ({
+                        id: el.getAttribute(REGION_ATTR),
+                        xpath: xpathOf(el),
+                        html: el.outerHTML,
+                    })),
+            };
+            this.dirty.clear();
+            this.full = false;
+            return snapshot;
+        },
+    };
+
+    new MutationObserver((records) => {
+        for (const record of records) {
+            if (record.attributeName === REGION_ATTR) continue;
+            const target =
+                record.target.nodeType === Node.ELEMENT_NODE
+                    ? record.target
+                    : record.target.parentElement;
+            const region = target && target.closest(`[${REGION_ATTR}]`);
+            if (region) {
+                tracker.dirty.add(region.getAttribute(REGION_ATTR));
+            } else {
+                tracker.full = true;
+            }
+        }
+    }).observe(document, {
+        subtree: true,
+        childList: true,
+        attributes: true,
+        characterData: true,
+    });
+
+    window.__agentTracker = tracker;
+})();
+"""
+
+
+def region_id_prefix(region_id: int) -> str:
+    # 1 -> "a", 26 -> "z", 27 -> "aa"
+    prefix = ""
+    while region_id > 0:
+        region_id, remainder = divmod(region_id - 1, 26)
+        prefix = chr(ord("a") + remainder) + prefix
+    return prefix
+
+
+@dataclass
+class SimplifiedRegion:
+    html: str
+    simplified_html: str
+    id_to_xpath: Dict[str, str]
+
+
+def simplify_region(region_id: str, xpath: str, html: str) -> SimplifiedRegion:
+    soup, id_to_xpath = simplify_html(html, collapse_tags=True, compact_ids=False)
+
+    # Xpaths are computed on the fragment, where the region root sits at
+    # /html/body/<tag>, so rebase them onto the region's place in the page
+    root_tag = BeautifulSoup(html, "html.parser").find(True)
+    fragment_root = f"/html/body/{root_tag.name}" if root_tag else "/html/body"
+    id_to_xpath = {
+        element_id: xpath + element_xpath[len(fragment_root) :]
+        for element_id, element_xpath in id_to_xpath.items()
+        if element_xpath.startswith(fragment_root)
+    }
+
+    soup, id_to_xpath = compact_element_ids(
+        soup, id_to_xpath, prefix=region_id_prefix(int(region_id))
+    )
+    return SimplifiedRegion(
+        html=html,
+        simplified_html=serialize_simplified_html(soup),
+        id_to_xpath=id_to_xpath,
+    )
+
+
+class DOMTracker:
+    """
+    Keeps the simplified html of a page up to date by only re-fetching and
+    re-simplifying the regions of the page that changed since the last snapshot.
+    With a `processing_service`, the changed regions are simplified and diffed
+    in parallel worker processes.
+    """
+
+    def __init__(
+        self,
+        page: Page,
+        max_region_size: int = MAX_REGION_SIZE,
+        processing_service: Optional[HTMLProcessingService] = None,
+    ):
+        self.page = page
+        self.max_region_size = max_region_size
+        self.processing_service = processing_service
+        self.regions: Dict[str, SimplifiedRegion] = {}
+        self.order: List[str] = []
+        page.add_init_script(TRACKER_SCRIPT)
+
+    @property
+    def html(self) -> str:
+        # The html of the tracked regions in page order
+        return "".join(self.regions[region_id].html for region_id in self.order)
+
+    def snapshot(self) -> Tuple[str, Dict[str, str], Optional[str]]:
+        """
+        Returns the simplified html, the id to xpath dict and a diff of the
+        regions that changed. After a navigation or another full snapshot the
+        diff covers all of the tracked regions, and it is None on the first
+        snapshot of the page.
+        """
+        # Pages opened before the tracker was created don't have the init script
+        self.page.evaluate(TRACKER_SCRIPT)
+        snapshot = self.page.evaluate(
+            "(maxRegionSize) => window.__agentTracker.collect(maxRegionSize)",
+            self.max_region_size,
+        )
+
+        full_diff = snapshot["full"] and bool(self.regions)
+        if full_diff:
+            # The regions were partitioned again, so diff the whole tracked page,
+            # from the cached regions on both sides
+            changed_regions = [
+                (self.html, "".join(region["html"] for region in snapshot["dirty"]))
+            ]
+        else:
+            changed_regions = [
+                (self.regions[region["id"]].html, region["html"])
+                for region in snapshot["dirty"]
+                if region["id"] in self.regions
+            ]
+        if snapshot["full"]:
+            self.regions = {}
+
+        if self.processing_service:
+            simplified_regions = [
+                SimplifiedRegion(
+                    html=region["html"],
+                    simplified_html=simplified_html,
+                    id_to_xpath=id_to_xpath,
+                )
+                for region, (simplified_html, id_to_xpath) in zip(
+                    snapshot["dirty"],
+                    self.processing_service.simplify_regions(
+                        [
+                            (region["id"], region["xpath"], region["html"])
+                            for region in snapshot["dirty"]
+                        ]
+                    ),
+                )
+            ]
+            changes = self.processing_service.diff_many(changed_regions)
+        else:
+            simplified_regions = [
+                simplify_region(region["id"], region["xpath"], region["html"])
+                for region in snapshot["dirty"]
+            ]
+            changes = [
+                html_diff(
+                    sanitize_html_for_diffing(old_html).prettify(),
+                    sanitize_html_for_diffing(new_html).prettify(),
+                )
+                for old_html, new_html in changed_regions
+            ]
+
+        for region, simplified_region in zip(snapshot["dirty"], simplified_regions):
+            self.regions[region["id"]] = simplified_region
+
+        self.order = [
+            region_id for region_id in snapshot["order"] if region_id in self.regions
+        ]
+        self.regions = {region_id: self.regions[region_id] for region_id in self.order}
+
+        simplified_html = "".join(
+            self.regions[region_id].simplified_html for region_id in self.order
+        )
+        id_to_xpath = {}
+        for region_id in self.order:
+            id_to_xpath.update(self.regions[region_id].id_to_xpath)
+
+        return (
+            simplified_html,
+            id_to_xpath,
+            (
+                None
+                if snapshot["full"] and not full_diff
+                else "\n".join(change for change in changes if change)
+            ),
+        )
@@ -0,0 +1,202 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from webpage import (
+    get_id_to_xpath_dict,
+    html_diff,
+    sanitize_html_for_diffing,
+    serialize_simplified_html,
+    simplify_html,
+    summarize_html,
+)
+
+# Pages larger than this are handed to workers through shared memory instead of
+# being pickled into the task queue
+SHARED_MEMORY_THRESHOLD = 64 * 1024
+
+# Either the encoded html itself, or the name and length of a shared memory block
+HTMLRef = Union[bytes, Tuple[str, int]]
+
+
+def _read_html(html_ref: HTMLRef) -> str:
+    if isinstance(html_ref, bytes):
+        return html_ref.decode("utf-8")
+
+    name, length = html_ref
+    try:
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:  # track was added in python 3.13
+        shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:length]).decode("utf-8")
+    finally:
+        shm.close()
+
+
+def _simplify_page(html_ref: HTMLRef, collapse_tags: bool = True):
+    soup, id_to_xpath = simplify_html(_read_html(html_ref), collapse_tags=collapse_tags)
+    # BeautifulSoup trees are expensive to pickle, so only the text crosses back
+    return serialize_simplified_html(soup), id_to_xpath
+
+
+def _get_id_to_xpath(html_ref: HTMLRef):
+    return get_id_to_xpath_dict(_read_html(html_ref))
+
+
+def _sanitize_page(html_ref: HTMLRef):
+    return sanitize_html_for_diffing(_read_html(html_ref)).prettify()
+
+
+def _summarize_page(html_ref: HTMLRef):
+    return summarize_html(_read_html(html_ref))
+
+
+def _simplify_region(html_ref: HTMLRef, region_id: str, xpath: str):
+    # Imported here because dom_tracking uses this service
+    from dom_tracking import simplify_region
+
+    region = simplify_region(region_id, xpath, _read_html(html_ref))
+    return region.simplified_html, region.id_to_xpath
+
+
+def _diff_pages(old_html_ref: HTMLRef, new_html_ref: HTMLRef):
+    sanit_1 = sanitize_html_for_diffing(_read_html(old_html_ref)).prettify()
+    sanit_2 = sanitize_html_for_diffing(_read_html(new_html_ref)).prettify()
+    return html_diff(sanit_1, sanit_2)
+
+
+class HTMLProcessingService:
+    """
+    Runs the CPU bound BeautifulSoup processing from webpage.py in a pool of
+    worker processes so that agents sharing a process don't serialize on the GIL.
+
+    At most `max_pending` tasks are queued at once. Submitting more blocks the
+    caller (or the awaiting coroutine) until a worker frees up.
+    """
+
+    def __init__(
+        self, max_workers: Optional[int] = None, max_pending: Optional[int] = None
+    ):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.max_workers * 2
+        # Workers share the parent's resource tracker, which unlinks shared memory
+        # blocks once the parent releases them
+        resource_tracker.ensure_running()
+        # Forking a process that is driving playwright is unsafe, so always spawn
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.max_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        self._pending = threading.BoundedSemaphore(self.max_pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+    def _to_ref(self, html: str, shared_blocks: list) -> HTMLRef:
+        data = html.encode("utf-8")
+        if len(data) < SHARED_MEMORY_THRESHOLD:
+            return data
+
+        shm = shared_memory.SharedMemory(create=True, size=len(data))
+        shm.buf[: len(data)] = data
+        shared_blocks.append(shm)
+        return (shm.name, len(data))
+
+    def submit(self, fn: Callable, *htmls: str, block: bool = True, **kwargs) -> Future:
+        if not self._pending.acquire(blocking=block):
+            raise RuntimeError("HTML processing queue is full")
+
+        return self._submit(fn, htmls, kwargs)
+
+    def _submit(self, fn: Callable, htmls, kwargs) -> Future:
+        # The caller must already hold a slot in self._pending
+        shared_blocks = []
+        try:
+            html_refs = [self._to_ref(html, shared_blocks) for html in htmls]
+            future = self._executor.submit(fn, *html_refs, **kwargs)
+        except Exception:
+            self._release(shared_blocks)
+            raise
+
+        future.add_done_callback(lambda _: self._release(shared_blocks))
+        return future
+
+    def _release(self, shared_blocks: list):
+        for shm in shared_blocks:
+            shm.close()
+            shm.unlink()
+        self._pending.release()
+
+    async def submit_async(self, fn: Callable, *htmls: str, **kwargs):
+        # Wait for a free slot without blocking the event loop
+        while not self._pending.acquire(blocking=False):
+            await asyncio.sleep(0.01)
+        return await asyncio.wrap_future(self._submit(fn, htmls, kwargs))
+
+    def simplify(
+        self, html: str, collapse_tags: bool = True
+    ) -> Tuple[str, Dict[str, str]]:
+        return self.submit(_simplify_page, html, collapse_tags=collapse_tags).result()
+
+    def id_to_xpath(self, html: str) -> Dict[str, str]:
+        return self.submit(_get_id_to_xpath, html).result()
+
+    def sanitize_for_diffing(self, html: str) -> str:
+        return self.submit(_sanitize_page, html).result()
+
+    def diff(self, old_html: str, new_html: str) -> str:
+        return self.submit(_diff_pages, old_html, new_html).result()
+
+    def summarize_many(self, htmls: List[str]) -> List[str]:
+        # Submit every page before waiting so that they are summarized in parallel
+        futures = [self.submit(_summarize_page, html) for html in htmls]
+        return [future.result() for future in futures]
+
+    def simplify_regions(
+        self, regions: List[Tuple[str, str, str]]
+    ) -> List[Tuple[str, Dict[str, str]]]:
+        """
+        Simplify (region id, xpath, html) regions of a page in parallel, see
+        dom_tracking.simplify_region.
+        """
+        futures = [
+            self.submit(_simplify_region, html, region_id=region_id, xpath=xpath)
+            for region_id, xpath, html in regions
+        ]
+        return [future.result() for future in futures]
+
+    def diff_many(self, html_pairs: List[Tuple[str, str]]) -> List[str]:
+        futures = [
+            self.submit(_diff_pages, old_html, new_html)
+            for old_html, new_html in html_pairs
+        ]
+        return [future.result() for future in futures]
+
+    async def simplify_async(
+        self, html: str, collapse_tags: bool = True
+    ) -> Tuple[str, Dict[str, str]]:
+        return await self.submit_async(
+            _simplify_page, html, collapse_tags=collapse_tags
+        )
+
+    async def id_to_xpath_async(self, html: str) -> Dict[str, str]:
+        return await self.submit_async(_get_id_to_xpath, html)
+
+    async def sanitize_for_diffing_async(self, html: str) -> str:
+        return await self.submit_async(_sanitize_page, html)
+
+    async def diff_async(self, old_html: str, new_html: str) -> str:
+        return await self.submit_async(_diff_pages, old_html, new_html)
+
+    async def summarize_async(self, html: str) -> str:
+        return await self.submit_async(_summarize_page, html)
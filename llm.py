@@ -1,8 +1,11 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+import json
 import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
 from dotenv import load_dotenv
 import google.generativeai as genai
-from termcolor import colored
+from agent_logging import logger
 from openai import OpenAI
 
 load_dotenv()
@@ -25,8 +28,10 @@ class GeminiUsage:
 
         turn_cost = self._calculate_cost(len(prompt), len(llm_output))
 
-        print(colored(f"Turn cost: ${turn_cost}", "green"))
-        print(colored(f"Total cost: ${self.total_cost}", "blue"))
+        logger.info(
+            f"Turn cost: ${turn_cost}, total cost: ${self.total_cost}",
+            extra={"turn_cost": turn_cost, "total_cost": self.total_cost},
+        )
 
         return turn_cost
 
@@ -74,6 +79,104 @@ def call_gemini(
     return llm_output
 
 
+@dataclass
+class FunctionCall:
+    name: str
+    args: Dict[str, Any]
+
+    def __str__(self):
+        args_str = ", ".join(f"{key}={value!r}" for key, value in self.args.items())
+        return f"{self.name}({args_str})"
+
+
+@dataclass
+class StructuredLLMOutput:
+    text: str
+    function_calls: List[FunctionCall] = field(default_factory=list)
+
+    def __str__(self):
+        return "\n".join(
+            [self.text] + [str(function_call) for function_call in self.function_calls]
+        ).strip()
+
+
+def _to_gemini_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    # Gemini only accepts an OpenAPI subset with upper case type names
+    gemini_schema = {}
+    for key, value in schema.items():
+        if key == "type":
+            gemini_schema[key] = value.upper()
+        elif key == "properties":
+            gemini_schema[key] = {
+                name: _to_gemini_schema(prop) for name, prop in value.items()
+            }
+        elif key == "items":
+            gemini_schema[key] = _to_gemini_schema(value)
+        elif key in ("description", "required", "enum"):
+            gemini_schema[key] = value
+    return gemini_schema
+
+
+def _proto_to_python(value):
+    if hasattr(value, "items"):
+        return {key: _proto_to_python(val) for key, val in value.items()}
+    if isinstance(value, (str, bytes)):
+        return value
+    if hasattr(value, "__iter__"):
+        return [_proto_to_python(val) for val in value]
+    return value
+
+
+def call_gemini_with_tools(
+    prompt: str,
+    function_declarations: List[Dict[str, Any]],
+    gemini_usage: GeminiUsage = GeminiUsage(),
+    temperature=0.3,
+) -> StructuredLLMOutput:
+    model = genai.GenerativeModel(
+        model_name="gemini-pro",
+        generation_config={
+            "temperature": temperature,
+            "top_p": 1,
+            "top_k": 1,
+            "max_output_tokens": 2048,
+        },
+        tools=[
+            {
+                "function_declarations": [
+                    {
+                        **declaration,
+                        "parameters": _to_gemini_schema(declaration["parameters"]),
+                    }
+                    for declaration in function_declarations
+                ]
+            }
+        ],
+    )
+
+    response = model.generate_content(prompt)
+
+    text_parts = []
+    function_calls = []
+    for part in response.candidates[0].content.parts:
+        if part.function_call and part.function_call.name:
+            function_calls.append(
+                FunctionCall(
+                    name=part.function_call.name,
+                    args=_proto_to_python(part.function_call.args),
+                )
+            )
+        elif part.text:
+            text_parts.append(part.text)
+
+    llm_output = StructuredLLMOutput(
+        text="\n".join(text_parts), function_calls=function_calls
+    )
+    gemini_usage.increment(prompt=prompt, llm_output=str(llm_output))
+
+    return llm_output
+
+
 def call_openai(prompt: str, temperature: float = 0.0):
     client = OpenAI(
         api_key=OPENAI_API_KEY,
@@ -94,6 +197,45 @@ def call_openai(prompt: str, temperature: float = 0.0):
     return response.choices[0].message.content
 
 
+def call_openai_with_tools(
+    prompt: str,
+    function_declarations: List[Dict[str, Any]],
+    temperature: float = 0.0,
+) -> StructuredLLMOutput:
+    client = OpenAI(
+        api_key=OPENAI_API_KEY,
+    )
+
+    response = client.chat.completions.create(
+        model="gpt-3.5-turbo",
+        messages=[
+            {
+                "role": "system",
+                "content": "You are a helpful assistant who is able to interact with a web browser.",
+            },
+            {"role": "user", "content": prompt},
+        ],
+        tools=[
+            {"type": "function", "function": declaration}
+            for declaration in function_declarations
+        ],
+        temperature=temperature,
+    )
+
+    message = response.choices[0].message
+    function_calls = []
+    for tool_call in message.tool_calls or []:
+        try:
+            args = json.loads(tool_call.function.arguments)
+        except json.JSONDecodeError:
+            continue
+        function_calls.append(FunctionCall(name=tool_call.function.name, args=args))
+
+    return StructuredLLMOutput(
+        text=message.content or "", function_calls=function_calls
+    )
+
+
 def call_solar(prompt: str, temperature: float = 0.0):
     client = OpenAI(api_key=SOLAR_API_KEY, base_url="https://api.upstage.ai/v1/solar")
 
@@ -110,3 +252,58 @@ def call_solar(prompt: str, temperature: float = 0.0):
     )
 
     return response.choices[0].message.content
+
+
+class MockLLM:
+    """
+    Stands in for Gemini in benchmarks, without network calls or cost. Every
+    call returns whatever `respond(prompt, function_declarations)` returns, so
+    the responses can be scripted, after a delay of `latency` seconds plus
+    `latency_per_1k_chars` for every 1000 prompt characters. Usage is counted
+    the same way as for Gemini.
+    """
+
+    def __init__(
+        self,
+        respond: Callable[
+            [str, Optional[List[Dict[str, Any]]]], Union[str, StructuredLLMOutput]
+        ],
+        latency: float = 0.0,
+        latency_per_1k_chars: float = 0.0,
+    ):
+        self.respond = respond
+        self.latency = latency
+        self.latency_per_1k_chars = latency_per_1k_chars
+        self.calls = 0
+
+    def _call(
+        self, prompt: str, function_declarations: Optional[List[Dict[str, Any]]]
+    ) -> StructuredLLMOutput:
+        self.calls += 1
+        time.sleep(self.latency + self.latency_per_1k_chars * len(prompt) / 1000)
+        llm_output = self.respond(prompt, function_declarations)
+        if isinstance(llm_output, str):
+            llm_output = StructuredLLMOutput(text=llm_output)
+        return llm_output
+
+    def call_gemini(
+        self,
+        prompt: str,
+        gemini_usage: GeminiUsage = GeminiUsage(),
+        temperature=0.3,
+        chat: bool = True,
+    ) -> str:
+        llm_output = str(self._call(prompt, None))
+        gemini_usage.increment(prompt=prompt, llm_output=llm_output)
+        return llm_output
+
+    def call_gemini_with_tools(
+        self,
+        prompt: str,
+        function_declarations: List[Dict[str, Any]],
+        gemini_usage: GeminiUsage = GeminiUsage(),
+        temperature=0.3,
+    ) -> StructuredLLMOutput:
+        llm_output = self._call(prompt, function_declarations)
+        gemini_usage.increment(prompt=prompt, llm_output=str(llm_output))
+        return llm_output
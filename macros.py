@@ -0,0 +1,261 @@
+from __future__ import annotations
+import ast
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Any, Collection, Dict, List, Optional
+from urllib.parse import urlparse
+from agent_logging import logger
+
+
+def page_domain(url: Optional[str]) -> str:
+    return urlparse(url).netloc.lower() if url else ""
+
+
+def page_fingerprint(browser_page) -> str:
+    """
+    Identify a page state by its url path and the location of its elements, so
+    that the same page on a later run gets the same fingerprint.
+    """
+    if browser_page.url is None:
+        return "about:blank"
+
+    parsed_url = urlparse(browser_page.url)
+    # Ids are renumbered on every snapshot, so hash where the elements are instead
+    xpaths = sorted((browser_page.id_to_xpath or {}).values())
+    digest = hashlib.sha1("\n".join(xpaths).encode("utf-8")).hexdigest()[:16]
+    return f"{parsed_url.netloc.lower()}{parsed_url.path}#{digest}"
+
+
+@dataclass
+class MacroStep:
+    fingerprint: str
+    url: Optional[str]
+    action_name: str
+    args: str
+    action_description: str
+    kwargs: Optional[Dict[str, Any]] = None
+    element_id: Optional[str] = None
+    # Where the element the step acts on was when it was recorded
+    xpath: Optional[str] = None
+
+    @classmethod
+    def from_turn(cls, turn) -> MacroStep:
+        action_to_execute = turn.actions_to_execute[0]
+        kwargs = action_to_execute.kwargs or {}
+        element_id = kwargs.get("id") or _parse_element_id(action_to_execute.args)
+        return cls(
+            fingerprint=page_fingerprint(turn.browser_page),
+            url=turn.browser_page.url,
+            action_name=action_to_execute.action_name,
+            args=action_to_execute.args,
+            action_description=turn.action_description,
+            kwargs=action_to_execute.kwargs,
+            element_id=element_id,
+            xpath=(turn.browser_page.id_to_xpath or {}).get(element_id),
+        )
+
+    def matches(self, browser_page) -> bool:
+        # The page must look like it did when the step was recorded, and the
+        # element's id must still name the recorded element, resolving to
+        # exactly one node. Ids are numbered per snapshot, so the same page can
+        # give an id to a different element.
+        if page_fingerprint(browser_page) != self.fingerprint:
+            return False
+        if self.element_id is None:
+            return True
+
+        xpath = (browser_page.id_to_xpath or {}).get(self.element_id)
+        if xpath is None or xpath != self.xpath:
+            return False
+        try:
+            return browser_page.page.locator(f"xpath={xpath}").count() == 1
+        except Exception:
+            return False
+
+
+def _parse_element_id(args: str) -> Optional[str]:
+    try:
+        call = ast.parse(f"f({args})", mode="eval").body
+    except SyntaxError:
+        return None
+    for keyword in call.keywords:
+        if keyword.arg == "id" and isinstance(keyword.value, ast.Constant):
+            return str(keyword.value.value)
+    return None
+
+
+@dataclass
+class MacroFlow:
+    steps: List[MacroStep]
+    # Whether the run that recorded the flow completed the task
+    verified: bool = False
+
+
+def _load_flow(flow) -> MacroFlow:
+    # Flows used to be stored as a bare list of steps
+    if isinstance(flow, list):
+        return MacroFlow(steps=[MacroStep(**step) for step in flow])
+    return MacroFlow(
+        steps=[MacroStep(**step) for step in flow["steps"]],
+        verified=flow.get("verified", False),
+    )
+
+
+class MacroReplay:
+    def __init__(
+        self,
+        domain: str,
+        steps: List[MacroStep],
+        start: int,
+        skip_fingerprints: Collection[str] = (),
+    ):
+        self.domain = domain
+        self.steps = steps
+        self.position = start
+        # Pages where a replayed step failed earlier in the run
+        self.skip_fingerprints = skip_fingerprints
+
+    @property
+    def exhausted(self) -> bool:
+        return self.position >= len(self.steps)
+
+    def next_step(self, browser_page) -> Optional[MacroStep]:
+        if self.exhausted:
+            return None
+
+        step = self.steps[self.position]
+        if step.fingerprint in self.skip_fingerprints or not step.matches(browser_page):
+            logger.info(
+                f"Macro step {self.position + 1}/{len(self.steps)} on {self.domain} does not match the page, falling back to the LLM"
+            )
+            return None
+
+        self.position += 1
+        return step
+
+
+class MacroStore:
+    """
+    Successful action sequences per task and domain, persisted as json so that
+    later runs of the same task can replay them without calling the LLM.
+
+    Steps are keyed by task because the text they type (addresses, sizes) is
+    specific to the task they were recorded for.
+
+    Only flows from runs that completed the task are replayed. A verified flow
+    replaces a flow that wasn't verified, or a longer verified one. A flow that
+    wasn't verified is kept until the domain has a verified one, and the latest
+    such flow replaces the previous one.
+    """
+
+    def __init__(self, path: str = ".macros.json"):
+        self.path = path
+        # task -> domain -> flow
+        self.macros: Dict[str, Dict[str, MacroFlow]] = self.load()
+
+    def load(self) -> Dict[str, Dict[str, MacroFlow]]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return {
+                task: {domain: _load_flow(flow) for domain, flow in domains.items()}
+                for task, domains in json.load(f).items()
+            }
+
+    @contextmanager
+    def locked(self):
+        # Held across load, merge and save so that workers on one machine
+        # sharing the file don't drop each other's flows
+        with open(f"{self.path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def save(self):
+        # Write a temporary file and swap it in, so that readers never see a
+        # partially written store
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(
+                    {
+                        task: {domain: asdict(flow) for domain, flow in domains.items()}
+                        for task, domains in self.macros.items()
+                    },
+                    f,
+                    indent=2,
+                )
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def record(self, task: str, steps: List[MacroStep], verified: bool = False):
+        steps_by_domain: Dict[str, List[MacroStep]] = {}
+        for step in steps:
+            steps_by_domain.setdefault(page_domain(step.url), []).append(step)
+
+        with self.locked():
+            # Pick up flows that other workers recorded since this store was loaded
+            self.macros = self.load()
+            task_macros = self.macros.setdefault(task, {})
+            for domain, domain_steps in steps_by_domain.items():
+                existing_flow = task_macros.get(domain)
+                if (
+                    existing_flow is None
+                    or not existing_flow.verified
+                    or verified
+                    and len(domain_steps) <= len(existing_flow.steps)
+                ):
+                    task_macros[domain] = MacroFlow(
+                        steps=domain_steps, verified=verified
+                    )
+
+            self.save()
+
+    def start_replay(
+        self,
+        task: str,
+        browser_page,
+        start: int = 0,
+        skip_fingerprints: Collection[str] = (),
+    ) -> Optional[MacroReplay]:
+        """
+        Replay the domain's flow from the first step at or after `start` that
+        was recorded on this page, unless a step failed on this page already.
+        """
+        domain = page_domain(browser_page.url)
+        flow = self.macros.get(task, {}).get(domain)
+        if flow is None or not flow.verified or not flow.steps:
+            return None
+        steps = flow.steps
+
+        fingerprint = page_fingerprint(browser_page)
+        if fingerprint in skip_fingerprints:
+            return None
+        start = next(
+            (
+                i
+                for i in range(start, len(steps))
+                if steps[i].fingerprint == fingerprint
+            ),
+            None,
+        )
+        if start is None:
+            return None
+
+        return MacroReplay(
+            domain=domain,
+            steps=steps,
+            start=start,
+            skip_fingerprints=skip_fingerprints,
+        )
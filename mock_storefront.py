@@ -0,0 +1,332 @@
+import html
+import json
+import threading
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+from urllib.parse import parse_qs, urlparse
+
+PIZZAS = {
+    "pepperoni": "Pepperoni",
+    "margherita": "Margherita",
+    "veggie": "Veggie Supreme",
+}
+
+SIZE_PRICES = {
+    "small": 9.99,
+    "medium": 12.99,
+    "large": 15.99,
+}
+
+# Adding to the cart updates the page in place, like most real storefronts
+MENU_SCRIPT = """
+async function addToCart(pizza) {
+    const size = document.getElementById(`${pizza}-size`).value;
+    const response = await fetch("/cart", {
+        method: "POST",
+        headers: { "Content-Type": "application/json" },
+        body: JSON.stringify({ pizza, size }),
+    });
+    const cart = await response.json();
+    document.querySelector(".cart-count").textContent = cart.items.length;
+    document.querySelector(".cart-status").textContent =
+        `Added a ${size} ${pizza} pizza to your cart`;
+}
+"""
+
+
+@dataclass
+class CartItem:
+    pizza: str
+    size: str
+
+    @property
+    def price(self) -> float:
+        return SIZE_PRICES[self.size]
+
+    def __str__(self):
+        return f"{self.size.capitalize()} {PIZZAS[self.pizza]} ${self.price:.2f}"
+
+
+@dataclass
+class Address:
+    street: str = ""
+    city: str = ""
+    zip: str = ""
+
+    def __str__(self):
+        return f"{self.street}, {self.city} {self.zip}"
+
+
+@dataclass
+class Order:
+    items: List[CartItem]
+    address: Address
+
+
+@dataclass
+class StorefrontState:
+    address: Optional[Address] = None
+    cart: List[CartItem] = field(default_factory=list)
+    orders: List[Order] = field(default_factory=list)
+
+
+def _page(title: str, body: str, cart_count: int, script: str = "") -> str:
+    return f"""<!DOCTYPE html>
+<html>
+<head>
+<title>{html.escape(title)} - Mock Pizza</title>
+<style>
+body {{ font-family: sans-serif; max-width: 640px; margin: 0 auto; }}
+header {{ display: flex; justify-content: space-between; align-items: center; }}
+section {{ border: 1px solid #ddd; padding: 8px; margin: 8px 0; }}
+</style>
+<script>{script}</script>
+</head>
+<body>
+<header>
+<h1>Mock Pizza</h1>
+<nav><a href="/menu">Menu</a> <a href="/cart" class="cart-link">Cart (<span class="cart-count">{cart_count}</span>)</a></nav>
+</header>
+<main>
+{body}
+</main>
+<footer><p>Mock Pizza is a test storefront. No pizza will be delivered.</p></footer>
+</body>
+</html>"""
+
+
+class StorefrontRequestHandler(BaseHTTPRequestHandler):
+    server: "StorefrontServer"
+
+    def log_message(self, format, *args):
+        # The default handler writes every request to stderr
+        pass
+
+    def _send(self, status: int, body: str, content_type: str = "text/html"):
+        content = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", f"{content_type}; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def _redirect(self, location: str):
+        self.send_response(303)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        storefront = self.server.storefront
+        url = urlparse(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        with storefront.lock:
+            if url.path == "/":
+                self._send(200, storefront.render_address_form())
+            elif url.path == "/menu":
+                if query.get("street"):
+                    storefront.state.address = Address(
+                        street=query.get("street", ""),
+                        city=query.get("city", ""),
+                        zip=query.get("zip", ""),
+                    )
+                self._send(200, storefront.render_menu())
+            elif url.path == "/cart":
+                self._send(200, storefront.render_cart())
+            elif url.path == "/checkout":
+                self._send(200, storefront.render_checkout())
+            elif url.path.startswith("/confirmation/"):
+                self._send(200, storefront.render_confirmation(url.path))
+            else:
+                self._send(404, "Not found", content_type="text/plain")
+
+    def do_POST(self):
+        storefront = self.server.storefront
+        url = urlparse(self.path)
+        content_length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(content_length).decode("utf-8")
+
+        with storefront.lock:
+            if url.path == "/cart":
+                try:
+                    item = CartItem(**json.loads(body))
+                    if item.pizza not in PIZZAS or item.size not in SIZE_PRICES:
+                        raise ValueError(f"Unknown item {item.size} {item.pizza}")
+                except (TypeError, ValueError):
+                    self._send(400, "Invalid item", content_type="text/plain")
+                    return
+                storefront.state.cart.append(item)
+                self._send(
+                    200,
+                    json.dumps(
+                        {"items": [str(item) for item in storefront.state.cart]}
+                    ),
+                    content_type="application/json",
+                )
+            elif url.path == "/order":
+                if not storefront.state.cart or storefront.state.address is None:
+                    self._redirect("/checkout")
+                    return
+                storefront.state.orders.append(
+                    Order(
+                        items=storefront.state.cart,
+                        address=storefront.state.address,
+                    )
+                )
+                storefront.state.cart = []
+                self._redirect(f"/confirmation/{len(storefront.state.orders)}")
+            else:
+                self._send(404, "Not found", content_type="text/plain")
+
+
+class StorefrontServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, storefront: "MockStorefront", host: str, port: int):
+        self.storefront = storefront
+        super().__init__((host, port), StorefrontRequestHandler)
+
+
+class MockStorefront:
+    """
+    A small pizza ordering site (address form, menu, cart and checkout) served
+    over localhost from a background thread, so that the agent can be run end to
+    end without a live site. It holds a single session, so only run one agent
+    against it at a time and `reset` it between runs.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.state = StorefrontState()
+        self.lock = threading.Lock()
+        self._server: Optional[StorefrontServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/"
+
+    def start(self):
+        self._server = StorefrontServer(self, self.host, self.port)
+        # Port 0 picks a free port
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def reset(self):
+        with self.lock:
+            self.state = StorefrontState()
+
+    @property
+    def orders(self) -> List[Order]:
+        with self.lock:
+            return list(self.state.orders)
+
+    def has_order(self) -> bool:
+        return bool(self.orders)
+
+    def render_address_form(self) -> str:
+        return _page(
+            "Start your order",
+            """
+<h2>Where should we deliver?</h2>
+<form method="get" action="/menu">
+<input type="text" name="street" placeholder="Street address" required>
+<input type="text" name="city" placeholder="City" required>
+<input type="text" name="zip" placeholder="ZIP code" required>
+<button type="submit">Start your order</button>
+</form>
+""",
+            cart_count=len(self.state.cart),
+        )
+
+    def render_menu(self) -> str:
+        address = self.state.address
+        delivery = (
+            f"<p>Delivering to {html.escape(str(address))}</p>"
+            if address
+            else '<p>No delivery address yet. <a href="/">Enter your address</a></p>'
+        )
+        options = "".join(
+            f'<option value="{size}">{size.capitalize()} ${price:.2f}</option>'
+            for size, price in SIZE_PRICES.items()
+        )
+        sections = "".join(
+            f"""
+<section>
+<h3>{name}</h3>
+<select id="{pizza}-size" title="{name} size">{options}</select>
+<button type="button" onclick="addToCart('{pizza}')">Add {name} to cart</button>
+</section>"""
+            for pizza, name in PIZZAS.items()
+        )
+        return _page(
+            "Menu",
+            f"""
+<h2>Menu</h2>
+{delivery}
+{sections}
+<p class="cart-status" role="status"></p>
+<a href="/cart">View cart</a>
+""",
+            cart_count=len(self.state.cart),
+            script=MENU_SCRIPT,
+        )
+
+    def render_cart(self) -> str:
+        if not self.state.cart:
+            body = '<h2>Your cart</h2><p>Your cart is empty.</p><a href="/menu">Back to menu</a>'
+        else:
+            items = "".join(
+                f"<li>{html.escape(str(item))}</li>" for item in self.state.cart
+            )
+            body = f"""
+<h2>Your cart</h2>
+<ul>{items}</ul>
+<a href="/menu">Continue shopping</a>
+<a href="/checkout">Checkout</a>
+"""
+        return _page("Cart", body, cart_count=len(self.state.cart))
+
+    def render_checkout(self) -> str:
+        address = self.state.address
+        if not self.state.cart:
+            body = '<h2>Checkout</h2><p>Your cart is empty.</p><a href="/menu">Back to menu</a>'
+        elif address is None:
+            body = '<h2>Checkout</h2><p>We need a delivery address first.</p><a href="/">Enter your address</a>'
+        else:
+            items = "".join(
+                f"<li>{html.escape(str(item))}</li>" for item in self.state.cart
+            )
+            total = sum(item.price for item in self.state.cart)
+            body = f"""
+<h2>Checkout</h2>
+<p>Delivering to {html.escape(str(address))}</p>
+<ul>{items}</ul>
+<p>Total: ${total:.2f}</p>
+<form method="post" action="/order">
+<button type="submit">Place order</button>
+</form>
+"""
+        return _page("Checkout", body, cart_count=len(self.state.cart))
+
+    def render_confirmation(self, path: str) -> str:
+        try:
+            order_number = int(path.rsplit("/", 1)[1])
+            order = self.state.orders[order_number - 1]
+        except (ValueError, IndexError):
+            return _page("Order not found", "<p>Order not found.</p>", cart_count=0)
+        return _page(
+            "Order placed",
+            f"<h2>Thank you!</h2><p>Order #{order_number} is on its way to {html.escape(str(order.address))}.</p>",
+            cart_count=len(self.state.cart),
+        )
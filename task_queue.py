@@ -0,0 +1,310 @@
+from __future__ import annotations
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from enum import Enum
+from typing import Any, Dict, List, Optional
+from agent_logging import configure_logging, logger, set_log_context, shutdown_logging
+
+
+class TaskStatus(Enum):
+    PENDING = "pending"
+    LEASED = "leased"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class QueuedTask:
+    id: int
+    task: str
+    status: TaskStatus
+    attempts: int
+    max_attempts: int
+    lease_owner: Optional[str]
+    lease_expires_at: Optional[float]
+    result: Optional[Dict[str, Any]]
+    error: Optional[str]
+    created_at: float
+    updated_at: float
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> QueuedTask:
+        return cls(
+            **{
+                **dict(row),
+                "status": TaskStatus(row["status"]),
+                "result": json.loads(row["result"]) if row["result"] else None,
+            }
+        )
+
+
+class SQLiteTaskQueue:
+    """
+    A work queue backed by a single sqlite file, so it needs no broker service.
+    Workers on other machines can share it through a network filesystem that
+    supports file locking.
+
+    A worker leases a task for `lease_seconds` and must heartbeat before the
+    lease expires. Tasks whose lease expired (the worker crashed or hung) are
+    handed to the next worker until `max_attempts` is used up.
+    """
+
+    def __init__(self, path: str = "task_queue.sqlite3"):
+        self.path = path
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    task TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    lease_owner TEXT,
+                    lease_expires_at REAL,
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_expires_at)"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        # A connection per operation keeps the queue safe to use from any thread
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            # Take the write lock up front so that two workers can't lease the same task
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+    def submit(self, task: str, max_attempts: int = 3) -> int:
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO tasks (task, status, max_attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (task, TaskStatus.PENDING.value, max_attempts, now, now),
+            )
+            return cursor.lastrowid
+
+    def lease(self, worker_id: str, lease_seconds: float = 300) -> Optional[QueuedTask]:
+        now = time.time()
+        with self._transaction() as conn:
+            # Expired leases whose attempts are used up can't be retried
+            conn.execute(
+                "UPDATE tasks SET status = ?, error = ?, lease_owner = NULL, updated_at = ? WHERE status = ? AND lease_expires_at < ? AND attempts >= max_attempts",
+                (
+                    TaskStatus.FAILED.value,
+                    "Lease expired on the last attempt",
+                    now,
+                    TaskStatus.LEASED.value,
+                    now,
+                ),
+            )
+            row = conn.execute(
+                "SELECT * FROM tasks WHERE status = ? OR (status = ? AND lease_expires_at < ?) ORDER BY id LIMIT 1",
+                (TaskStatus.PENDING.value, TaskStatus.LEASED.value, now),
+            ).fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE tasks SET status = ?, attempts = attempts + 1, lease_owner = ?, lease_expires_at = ?, updated_at = ? WHERE id = ?",
+                (
+                    TaskStatus.LEASED.value,
+                    worker_id,
+                    now + lease_seconds,
+                    now,
+                    row["id"],
+                ),
+            )
+            row = conn.execute(
+                "SELECT * FROM tasks WHERE id = ?", (row["id"],)
+            ).fetchone()
+            return QueuedTask.from_row(row)
+
+    def heartbeat(
+        self, task_id: int, worker_id: str, lease_seconds: float = 300
+    ) -> bool:
+        """
+        Extend the lease. Returns False if the lease was lost to another worker,
+        in which case the caller should stop working on the task.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET lease_expires_at = ?, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (now + lease_seconds, now, task_id, TaskStatus.LEASED.value, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, task_id: int, worker_id: str, result: Dict[str, Any]) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE tasks SET status = ?, result = ?, error = NULL, lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (
+                    TaskStatus.DONE.value,
+                    json.dumps(result, default=str),
+                    now,
+                    task_id,
+                    TaskStatus.LEASED.value,
+                    worker_id,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def fail(self, task_id: int, worker_id: str, error: str) -> bool:
+        now = time.time()
+        with self._transaction() as conn:
+            # Retry the task unless this was its last attempt
+            cursor = conn.execute(
+                "UPDATE tasks SET status = CASE WHEN attempts >= max_attempts THEN ? ELSE ? END, error = ?, lease_owner = NULL, lease_expires_at = NULL, updated_at = ? WHERE id = ? AND status = ? AND lease_owner = ?",
+                (
+                    TaskStatus.FAILED.value,
+                    TaskStatus.PENDING.value,
+                    error,
+                    now,
+                    task_id,
+                    TaskStatus.LEASED.value,
+                    worker_id,
+                ),
+            )
+            return cursor.rowcount == 1
+
+    def tasks(self, status: Optional[TaskStatus] = None) -> List[QueuedTask]:
+        with self._transaction() as conn:
+            if status is None:
+                rows = conn.execute("SELECT * FROM tasks ORDER BY id").fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT * FROM tasks WHERE status = ? ORDER BY id", (status.value,)
+                ).fetchall()
+            return [QueuedTask.from_row(row) for row in rows]
+
+
+def agent_run_result_to_dict(agent_run_result) -> Dict[str, Any]:
+    return {
+        **asdict(agent_run_result),
+        "cost": agent_run_result.gemini_usage.total_cost,
+    }
+
+
+def run_worker(
+    queue: SQLiteTaskQueue,
+    worker_id: Optional[str] = None,
+    lease_seconds: float = 300,
+    poll_interval: float = 5,
+    max_turns: int = 50,
+    headless: bool = True,
+    exit_when_empty: bool = False,
+):
+    # Imported here so that submitting tasks doesn't need playwright or the LLM keys
+    from agent import run_agent
+
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    set_log_context(agent=worker_id)
+
+    while True:
+        queued_task = queue.lease(worker_id, lease_seconds=lease_seconds)
+        if queued_task is None:
+            if exit_when_empty:
+                return
+            time.sleep(poll_interval)
+            continue
+
+        set_log_context(task_id=queued_task.id)
+        logger.info(
+            f"Leased task {queued_task.id} (attempt {queued_task.attempts}/{queued_task.max_attempts}): {queued_task.task}"
+        )
+
+        def on_turn(turn: int):
+            # Heartbeat once per turn so that a hung agent loses its lease
+            if not queue.heartbeat(queued_task.id, worker_id, lease_seconds):
+                raise Exception("Lost the lease on the task")
+
+        try:
+            agent_run_result = run_agent(
+                queued_task.task,
+                max_turns=max_turns,
+                headless=headless,
+                on_turn=on_turn,
+            )
+        except Exception as e:
+            logger.exception(f"Task {queued_task.id} failed")
+            queue.fail(queued_task.id, worker_id, repr(e))
+            continue
+
+        queue.complete(
+            queued_task.id, worker_id, agent_run_result_to_dict(agent_run_result)
+        )
+        logger.info(f"Completed task {queued_task.id}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run agent tasks from a work queue")
+    parser.add_argument("--db", default="task_queue.sqlite3", help="Queue file")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Add tasks to the queue")
+    submit_parser.add_argument("tasks", nargs="+")
+    submit_parser.add_argument("--max-attempts", type=int, default=3)
+
+    worker_parser = subparsers.add_parser("worker", help="Pull and run tasks")
+    worker_parser.add_argument("--worker-id")
+    worker_parser.add_argument("--lease-seconds", type=float, default=300)
+    worker_parser.add_argument("--max-turns", type=int, default=50)
+    worker_parser.add_argument("--headed", action="store_true")
+    worker_parser.add_argument("--exit-when-empty", action="store_true")
+
+    subparsers.add_parser("results", help="Print the status of every task")
+
+    args = parser.parse_args()
+    queue = SQLiteTaskQueue(args.db)
+
+    if args.command == "submit":
+        for task in args.tasks:
+            print(queue.submit(task, max_attempts=args.max_attempts))
+    elif args.command == "worker":
+        configure_logging()
+        try:
+            run_worker(
+                queue,
+                worker_id=args.worker_id,
+                lease_seconds=args.lease_seconds,
+                max_turns=args.max_turns,
+                headless=not args.headed,
+                exit_when_empty=args.exit_when_empty,
+            )
+        finally:
+            shutdown_logging()
+    elif args.command == "results":
+        for queued_task in queue.tasks():
+            print(
+                json.dumps(
+                    {**asdict(queued_task), "status": queued_task.status.value},
+                    default=str,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
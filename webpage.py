@@ -4,6 +4,46 @@ from typing import Dict, Tuple
 import difflib
 from playwright.sync_api import Page, sync_playwright
 
+# Interactive tags that are always given an id the LLM can reference
+ID_TAGS = ["a", "button", "input", "textarea"]
+
+VOID_TAGS = {
+    "area",
+    "base",
+    "br",
+    "col",
+    "embed",
+    "hr",
+    "img",
+    "input",
+    "link",
+    "meta",
+    "source",
+    "track",
+    "wbr",
+}
+
+# Roles that a tag already has implicitly
+IMPLICIT_ROLES = {
+    "a": "link",
+    "button": "button",
+    "form": "form",
+    "img": "img",
+    "li": "listitem",
+    "nav": "navigation",
+    "ol": "list",
+    "select": "listbox",
+    "table": "table",
+    "textarea": "textbox",
+    "ul": "list",
+}
+
+# Attribute values that are the browser default for a tag
+DEFAULT_ATTRIBUTE_VALUES = {
+    ("input", "type"): "text",
+    ("button", "type"): "submit",
+}
+
 
 def remove_hidden_elements(soup, page: Page = None):
     # Remove input elements with type="hidden"
@@ -119,6 +159,46 @@ def delete_unnecessary_attributes(tag):
         del tag.attrs[attr]
 
 
+def delete_redundant_attributes(tag):
+    attrs_to_remove = [
+        attr
+        for attr, value in tag.attrs.items()
+        if DEFAULT_ATTRIBUTE_VALUES.get((tag.name, attr)) == value
+    ]
+
+    if tag.get("role") == IMPLICIT_ROLES.get(tag.name):
+        attrs_to_remove.append("role")
+
+    # A title that repeats the element's text adds nothing
+    if "title" in tag.attrs and tag["title"].strip() == tag.get_text().strip():
+        attrs_to_remove.append("title")
+
+    for attr in attrs_to_remove:
+        tag.attrs.pop(attr, None)
+
+
+def compact_element_ids(
+    soup: BeautifulSoup, id_to_xpath: Dict[str, str], prefix: str = ""
+) -> Tuple[BeautifulSoup, Dict[str, str]]:
+    """
+    Give every element with a retained id its own short token, numbered in
+    document order, and key the xpath dict by the new tokens.
+    """
+    compact_id_to_xpath = {}
+
+    for tag in soup.find_all(id=True):
+        original_id = str(tag["id"])
+        if original_id not in id_to_xpath:
+            del tag["id"]
+            continue
+
+        compact_id = f"{prefix}{len(compact_id_to_xpath) + 1}"
+        compact_id_to_xpath[compact_id] = id_to_xpath[original_id]
+        tag["id"] = compact_id
+
+    return soup, compact_id_to_xpath
+
+
 def collapse_tag(tag):
     if not isinstance(tag, element.Tag):
         # print("Skipping non-tag", tag)
@@ -183,19 +263,15 @@ def get_id_to_xpath_dict(html: str) -> Dict[str, str]:
 
 
 def simplify_html(
-    html, collapse_tags: bool = False, page: Page = None
+    html, collapse_tags: bool = False, page: Page = None, compact_ids: bool = True
 ) -> Tuple[BeautifulSoup, Dict[str, str]]:
     soup = BeautifulSoup(html, "html.parser")
     id_to_xpath_dict = {}
 
     curr_id = 1
+    seen_ids = set()
     for tag in soup.find_all(True):
-        if isinstance(tag, element.Tag) and tag.name in [
-            "a",
-            "button",
-            "input",
-            "textarea",
-        ]:
+        if isinstance(tag, element.Tag) and tag.name in ID_TAGS:
             if "id" not in tag.attrs or len(tag["id"]) == 0:
                 if "name" in tag.attrs:
                     tag["id"] = tag["name"]
@@ -204,6 +280,17 @@ def simplify_html(
 
             curr_id += 1
 
+        # Elements that share an id, such as radio inputs with the same name,
+        # must map to their own xpath
+        if tag.has_attr("id"):
+            element_id = str(tag["id"])
+            suffix = 2
+            while element_id in seen_ids:
+                element_id = f"{tag['id']}-{suffix}"
+                suffix += 1
+            tag["id"] = element_id
+            seen_ids.add(element_id)
+
     id_to_xpath_dict = get_id_to_xpath_dict(soup.prettify(formatter="minimal"))
 
     soup = remove_hidden_elements(soup, page)
@@ -220,14 +307,78 @@ def simplify_html(
 
     if collapse_tags:
         body = soup.find("body")
-        collapse_tag(body)
+        if body is not None:
+            collapse_tag(body)
+        else:
+            # Fragments such as a single region of the page have no body
+            for child in list(soup.contents):
+                collapse_tag(child)
 
     for tag in soup.find_all(True):
         delete_unnecessary_attributes(tag)
+        delete_redundant_attributes(tag)
+
+    if compact_ids:
+        soup, id_to_xpath_dict = compact_element_ids(soup, id_to_xpath_dict)
 
     return soup, id_to_xpath_dict
 
 
+def _serialize_attribute(name, value) -> str:
+    if isinstance(value, list):
+        value = " ".join(value)
+    value = str(value)
+    if value == "":
+        return name
+    if re.fullmatch(r"[^\s\"'=<>`]+", value):
+        return f"{name}={value.replace('&', '&amp;')}"
+    return '{}="{}"'.format(name, value.replace("&", "&amp;").replace('"', "&quot;"))
+
+
+def serialize_simplified_html(soup: BeautifulSoup) -> str:
+    """
+    Write the simplified html in its most compact text form in a single pass:
+    collapsed whitespace, no markup outside the body and unquoted attributes
+    where possible.
+    """
+    root = soup.find("body") or soup
+    parts = []
+    # Closing tags are pushed onto the stack as plain strings
+    stack = list(reversed(root.contents))
+
+    while stack:
+        node = stack.pop()
+        if isinstance(node, str) and not isinstance(node, NavigableString):
+            parts.append(node)
+        elif isinstance(node, element.Tag):
+            attrs = "".join(
+                f" {_serialize_attribute(name, value)}"
+                for name, value in node.attrs.items()
+            )
+            parts.append(f"<{node.name}{attrs}>")
+            if node.name not in VOID_TAGS:
+                stack.append(f"</{node.name}>")
+                stack.extend(reversed(node.contents))
+        elif isinstance(node, NavigableString) and not isinstance(
+            node, element.PreformattedString
+        ):
+            text = re.sub(r"\s+", " ", node)
+            # Whitespace between siblings such as "<a>One</a> <a>Two</a>" is
+            # kept, leading and trailing whitespace inside a tag is not
+            if text == " " and (
+                node.previous_sibling is None
+                or node.next_sibling is None
+                or not parts
+                or parts[-1][-1] == " "
+            ):
+                continue
+            parts.append(
+                text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+            )
+
+    return "".join(parts).strip()
+
+
 def sanitize_html_for_diffing(html) -> BeautifulSoup:
     soup = BeautifulSoup(html, "html.parser")
     for script in soup(["head", "script", "style", "link", "template", "meta"]):
@@ -237,7 +388,8 @@ def sanitize_html_for_diffing(html) -> BeautifulSoup:
         comment.extract()
 
     for tag in soup.find_all(True):
-        attrs_to_delete = ["tabindex"]
+        # data-agent-region is added to live pages by dom_tracking.DOMTracker
+        attrs_to_delete = ["tabindex", "data-agent-region"]
         for attr in attrs_to_delete:
             if attr in tag.attrs:
                 del tag.attrs[attr]
@@ -258,3 +410,35 @@ def html_diff(html1, html2):
         if line.startswith("- ") or line.startswith("+ "):
             filtered_diff.append(line)
     return "\n".join(filtered_diff)
+
+
+def summarize_html(html, max_text_chars: int = 600) -> str:
+    """
+    A few lines describing a page: its title, headings, how many elements can be
+    interacted with and the start of its visible text.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    title = soup.title.get_text(strip=True) if soup.title else ""
+
+    soup = remove_hidden_elements(soup)
+    for script in soup(["head", "script", "style", "link", "template", "meta"]):
+        script.decompose()
+
+    headings = [
+        heading.get_text(" ", strip=True)
+        for heading in soup.find_all(["h1", "h2", "h3"])
+        if heading.get_text(strip=True)
+    ][:8]
+    link_count = len(soup.find_all("a"))
+    button_count = len(soup.find_all("button"))
+    field_count = len(soup.find_all(["input", "textarea", "select"]))
+    text = re.sub(r"\s+", " ", soup.get_text(" ", strip=True))[:max_text_chars]
+
+    return "\n".join(
+        [
+            f"Title: {title}",
+            f"Headings: {'; '.join(headings)}",
+            f"{link_count} links, {button_count} buttons, {field_count} form fields",
+            f"Text: {text}",
+        ]
+    )